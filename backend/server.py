@@ -1,25 +1,1261 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Header, Request, HTTPException, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Match
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 import logging
+import queue
+import atexit
+import copy
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from collections import OrderedDict
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from typing import List, Literal, Optional, Union
 import uuid
-from datetime import datetime
+import json
+import base64
+import hashlib
+import re
+import importlib
+import time
+import random
+import asyncio
+import bisect
+import threading
+import contextvars
+from contextlib import aclosing, asynccontextmanager, contextmanager
+from datetime import datetime, timedelta, timezone
 import httpx
+from pymongo import ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
+# Metrics
+# A minimal Prometheus-compatible registry served at /metrics. Each metric
+# keeps its series in a dict keyed by a tuple of label values, guarded by a
+# lock because pymongo reports command events from Motor's worker threads.
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._values: dict = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, labels)} {value}" for labels, value in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: tuple = (), amount: float = 1):
+        self.inc(labels, -amount)
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self._series: dict = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts followed by the running sum
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            items = [(labels, list(series)) for labels, series in self._series.items()]
+        lines = []
+        for labels, series in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labels, labels, f'le="{le}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {cumulative}")
+        return lines
+
+
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route and status", ("method", "route", "status"))
+HTTP_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route"))
+HTTP_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests currently being served", ("method", "route"))
+MONGO_LATENCY = Histogram("mongo_operation_duration_seconds", "MongoDB command latency", ("collection", "command"))
+N8N_LATENCY = Histogram("n8n_request_duration_seconds", "n8n webhook call latency by outcome", ("outcome",))
+ERRORS = Counter("errors_total", "Errors by component and type", ("component", "type"))
+METRICS = [HTTP_REQUESTS, HTTP_LATENCY, HTTP_IN_PROGRESS, MONGO_LATENCY, N8N_LATENCY, ERRORS]
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+class MongoMetricsListener(monitoring.CommandListener):
+    """Times every command Motor sends, labelled by collection and command name"""
+
+    def __init__(self):
+        self._collections: dict = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore carries the cursor ID there and names the collection separately
+            collection = event.command.get("collection", "")
+        self._collections[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event) -> str:
+        collection = self._collections.pop((event.connection_id, event.request_id), "")
+        MONGO_LATENCY.observe((collection, event.command_name), event.duration_micros / 1e6)
+        return collection
+
+    def succeeded(self, event):
+        self._finish(event)
+
+    def failed(self, event):
+        self._finish(event)
+        ERRORS.inc(("mongo", event.failure.get("codeName", event.command_name)))
+
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request by its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _route(self, scope) -> str:
+        # Label by the route template, never the raw path, to bound cardinality
+        for route in scope["app"].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        labels = (scope["method"], self._route(scope))
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc(labels)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        except Exception as e:
+            ERRORS.inc(("http", type(e).__name__))
+            raise
+        finally:
+            HTTP_IN_PROGRESS.dec(labels)
+            HTTP_LATENCY.observe(labels, time.perf_counter() - start)
+            HTTP_REQUESTS.inc(labels + (str(status),))
+
+# Per-request timing
+# Handlers wrap their phases in timed("name"). The phase durations are sent to
+# the browser in a Server-Timing header, and requests slower than
+# SLOW_REQUEST_THRESHOLD_MS are written to the slow-request log with the full
+# breakdown. Outside of a request (e.g. background workers) timed() is a no-op.
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', '2000'))
+
+request_phases: contextvars.ContextVar = contextvars.ContextVar("request_phases", default=None)
+
+
+@contextmanager
+def timed(phase: str):
+    phases = request_phases.get()
+    if phases is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases.append((phase, (time.perf_counter() - start) * 1000))
+
+
+class ServerTimingMiddleware:
+    """Adds a Server-Timing header and logs requests over the slow threshold"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        phases: list = []
+        token = request_phases.set(phases)
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                total = (time.perf_counter() - start) * 1000
+                entries = [f"{name};dur={duration:.1f}" for name, duration in phases]
+                entries.append(f"total;dur={total:.1f}")
+                message.setdefault("headers", []).append((b"server-timing", ", ".join(entries).encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            request_phases.reset(token)
+            total = (time.perf_counter() - start) * 1000
+            if total >= SLOW_REQUEST_THRESHOLD_MS:
+                slow_logger.warning("Slow request", extra={
+                    "event": "slow_request",
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status,
+                    "total_ms": round(total, 1),
+                    "phases": [{"name": name, "ms": round(duration, 1)} for name, duration in phases],
+                })
+
 # MongoDB connection
+# minPoolSize keeps that many connections open in the background, so traffic
+# after a restart or a quiet period does not wait for new connections
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=[MongoMetricsListener()] if METRICS_ENABLED else [],
+)
 db = client[os.environ['DB_NAME']]
 
+# n8n webhook HTTP client
+# A single pooled client is shared by all requests so that consecutive chat
+# turns reuse open keep-alive connections to n8n instead of paying for a new
+# TCP+TLS handshake every time. It is created on startup and closed on shutdown.
+N8N_MAX_CONNECTIONS = int(os.environ.get('N8N_MAX_CONNECTIONS', '100'))
+N8N_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('N8N_MAX_KEEPALIVE_CONNECTIONS', '20'))
+N8N_KEEPALIVE_EXPIRY = float(os.environ.get('N8N_KEEPALIVE_EXPIRY', '30.0'))
+N8N_CONNECT_TIMEOUT = float(os.environ.get('N8N_CONNECT_TIMEOUT', '5.0'))
+N8N_READ_TIMEOUT = float(os.environ.get('N8N_READ_TIMEOUT', '30.0'))
+N8N_HTTP2 = os.environ.get('N8N_HTTP2', 'false').lower() in ('1', 'true', 'yes')
+
+http_client: Optional[httpx.AsyncClient] = None
+# Whether the client actually speaks HTTP/2, which N8N_HTTP2 alone does not
+# say when 'h2' is missing; None until the client is built
+n8n_http2: Optional[bool] = None
+n8n_pool_stats = {"requests": 0, "connections_opened": 0}
+
+
+def create_http_client() -> httpx.AsyncClient:
+    """Build the shared AsyncClient used for n8n webhook calls"""
+    global n8n_http2
+    http2 = N8N_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("N8N_HTTP2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+    n8n_http2 = http2
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=N8N_MAX_CONNECTIONS,
+            max_keepalive_connections=N8N_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=N8N_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            N8N_READ_TIMEOUT,
+            connect=N8N_CONNECT_TIMEOUT,
+            read=N8N_READ_TIMEOUT,
+        ),
+    )
+
+
+async def _trace_n8n_connection(event_name: str, info: dict):
+    # httpcore emits this event only when a brand-new connection is established,
+    # so requests minus opened connections is the number of reused connections.
+    if event_name == "connection.connect_tcp.complete":
+        n8n_pool_stats["connections_opened"] += 1
+
+
+async def post_to_n8n(webhook_url: str, payload: dict) -> httpx.Response:
+    """POST a payload to the n8n webhook over the shared connection pool"""
+    n8n_pool_stats["requests"] += 1
+    start = time.perf_counter()
+    try:
+        response = await http_client.post(
+            webhook_url,
+            json=payload,
+            extensions={"trace": _trace_n8n_connection},
+        )
+    except BaseException as e:
+        # Includes cancellation by the latency budget or a departed client
+        observe_n8n_call(start, e)
+        raise
+    observe_n8n_call(start, status_code=response.status_code)
+    return response
+
+
+def observe_n8n_call(start: float, error: Optional[BaseException] = None, status_code: Optional[int] = None):
+    """Record the latency of one webhook call, labelled by status class or error"""
+    if isinstance(error, asyncio.CancelledError):
+        outcome = "cancelled"
+    elif error is not None:
+        ERRORS.inc(("n8n", type(error).__name__))
+        outcome = "error"
+    else:
+        outcome = f"{status_code // 100}xx"
+    N8N_LATENCY.observe((outcome,), time.perf_counter() - start)
+
+
+def get_n8n_pool_stats() -> dict:
+    """Report connection reuse counters and the current state of the pool"""
+    requests_sent = n8n_pool_stats["requests"]
+    opened = n8n_pool_stats["connections_opened"]
+    reused = max(requests_sent - opened, 0)
+    stats = {
+        "requests": requests_sent,
+        "connections_opened": opened,
+        "connections_reused": reused,
+        "reuse_ratio": round(reused / requests_sent, 4) if requests_sent else 0.0,
+        "http2": n8n_http2,
+        "max_connections": N8N_MAX_CONNECTIONS,
+        "max_keepalive_connections": N8N_MAX_KEEPALIVE_CONNECTIONS,
+    }
+    # httpx does not expose pool internals publicly, so read them defensively
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []) or [])
+    stats["open_connections"] = len(connections)
+    stats["idle_connections"] = sum(1 for conn in connections if conn.is_idle())
+    return stats
+
+# n8n webhook resilience
+# Calls to n8n go through a bulkhead (a cap on concurrent calls) and a circuit
+# breaker. After N8N_BREAKER_FAILURES consecutive failures the breaker opens and
+# chat turns get the fallback reply immediately; after N8N_BREAKER_RESET_TIMEOUT
+# seconds a single trial call decides whether it closes again. Failures where
+# the request cannot have reached the workflow are optionally retried with
+# jittered backoff, all within a total N8N_LATENCY_BUDGET.
+N8N_BREAKER_FAILURES = int(os.environ.get('N8N_BREAKER_FAILURES', '5'))
+N8N_BREAKER_RESET_TIMEOUT = float(os.environ.get('N8N_BREAKER_RESET_TIMEOUT', '30'))
+N8N_MAX_CONCURRENT_CALLS = int(os.environ.get('N8N_MAX_CONCURRENT_CALLS', '50'))
+N8N_BULKHEAD_TIMEOUT = float(os.environ.get('N8N_BULKHEAD_TIMEOUT', '0.5'))
+N8N_RETRIES = int(os.environ.get('N8N_RETRIES', '0'))
+N8N_RETRY_BACKOFF = float(os.environ.get('N8N_RETRY_BACKOFF', '0.2'))
+N8N_LATENCY_BUDGET = float(os.environ.get('N8N_LATENCY_BUDGET', '30'))
+N8N_RETRY_GATEWAY_TIMEOUTS = os.environ.get('N8N_RETRY_GATEWAY_TIMEOUTS', 'false').lower() in ('1', 'true', 'yes')
+
+# Only failures that happen before the webhook could have started the workflow
+# (or that a gateway reports as transient) are safe to retry. A 504 usually
+# means the workflow is already running, so retrying it could book or email
+# twice; it is only retried when the workflow is known to be idempotent.
+RETRYABLE_N8N_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_N8N_STATUSES = (502, 503) + ((504,) if N8N_RETRY_GATEWAY_TIMEOUTS else ())
+
+
+class N8nUnavailable(Exception):
+    """Raised when an n8n call is refused without being attempted"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self._opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead; in half-open state only one trial call is let through"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        self.rejected += 1
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self._trial_in_flight = False
+        if self._opened_at is not None:
+            self._opened_at = None
+            logger.info("n8n circuit breaker closed")
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_in_flight = False
+        if self.state == self.HALF_OPEN or (self._opened_at is None and self.failures >= self.failure_threshold):
+            self._opened_at = time.monotonic()
+            self.trips += 1
+            logger.warning(f"n8n circuit breaker opened after {self.failures} consecutive failure(s)")
+
+    def release(self):
+        """Forget an allowed call that ended without a result, e.g. a cancelled stream"""
+        self._trial_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+            "failure_threshold": self.failure_threshold,
+            "reset_timeout_seconds": self.reset_timeout,
+        }
+
+
+n8n_breaker = CircuitBreaker(N8N_BREAKER_FAILURES, N8N_BREAKER_RESET_TIMEOUT)
+n8n_bulkhead = asyncio.Semaphore(N8N_MAX_CONCURRENT_CALLS)
+n8n_resilience_stats = {"in_flight": 0, "bulkhead_rejections": 0, "retries": 0, "budget_exceeded": 0}
+
+
+@asynccontextmanager
+async def n8n_call_slot():
+    """Hold one of the N8N_MAX_CONCURRENT_CALLS slots, failing fast if none frees up"""
+    try:
+        await asyncio.wait_for(n8n_bulkhead.acquire(), N8N_BULKHEAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        n8n_resilience_stats["bulkhead_rejections"] += 1
+        raise N8nUnavailable("too many concurrent n8n calls")
+    n8n_resilience_stats["in_flight"] += 1
+    try:
+        if not n8n_breaker.allow():
+            raise N8nUnavailable("n8n circuit breaker is open")
+        yield
+    finally:
+        n8n_resilience_stats["in_flight"] -= 1
+        n8n_bulkhead.release()
+
+
+async def call_n8n(webhook_url: str, payload: dict):
+    """POST to the webhook behind the bulkhead and breaker and return the decoded JSON reply"""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + N8N_LATENCY_BUDGET
+    attempt = 0
+    async with n8n_call_slot():
+        while True:
+            try:
+                response = await asyncio.wait_for(post_to_n8n(webhook_url, payload), deadline - loop.time())
+                response.raise_for_status()
+            except asyncio.TimeoutError:
+                n8n_resilience_stats["budget_exceeded"] += 1
+                n8n_breaker.record_failure()
+                raise httpx.TimeoutException(f"n8n call exceeded the {N8N_LATENCY_BUDGET}s latency budget")
+            except httpx.HTTPError as e:
+                n8n_breaker.record_failure()
+                retryable = isinstance(e, RETRYABLE_N8N_ERRORS) or (
+                    isinstance(e, httpx.HTTPStatusError) and e.response.status_code in RETRYABLE_N8N_STATUSES
+                )
+                delay = N8N_RETRY_BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if not retryable or attempt >= N8N_RETRIES or loop.time() + delay >= deadline:
+                    raise
+                attempt += 1
+                n8n_resilience_stats["retries"] += 1
+                await asyncio.sleep(delay)
+                if not n8n_breaker.allow():
+                    raise N8nUnavailable("n8n circuit breaker is open")
+                continue
+            except BaseException:
+                n8n_breaker.release()
+                raise
+            n8n_breaker.record_success()
+            return response.json()
+
+
+def get_n8n_resilience_stats() -> dict:
+    return {
+        "breaker": n8n_breaker.stats(),
+        "max_concurrent_calls": N8N_MAX_CONCURRENT_CALLS,
+        "latency_budget_seconds": N8N_LATENCY_BUDGET,
+        "retries_allowed": N8N_RETRIES,
+        **n8n_resilience_stats,
+    }
+
+# n8n configuration cache
+# The webhook URL is read on every chat turn but almost never changes, so it is
+# kept in memory. Writes through update_n8n_config refresh the local copy right
+# away; other uvicorn workers re-check the stored version at most every
+# N8N_CONFIG_TTL seconds and reload the document only when it has changed.
+N8N_CONFIG_TTL = float(os.environ.get('N8N_CONFIG_TTL', '30'))
+
+
+class N8nConfigCache:
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.config: dict = {}
+        self.version: Optional[str] = None
+        self.checked_at: Optional[float] = None
+        self.hits = 0
+        self.refreshes = 0
+        self.reloads = 0
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self) -> bool:
+        return self.checked_at is not None and time.monotonic() - self.checked_at < self.ttl
+
+    async def get(self) -> dict:
+        """Return the cached config, re-checking the database once the TTL expires"""
+        if self._is_fresh():
+            self.hits += 1
+            return self.config
+        async with self._lock:
+            # Another request may have refreshed while we waited for the lock
+            if not self._is_fresh():
+                await self._refresh()
+        return self.config
+
+    async def _refresh(self):
+        self.refreshes += 1
+        probe = await db.n8n_config.find_one({}, {"_id": 0, "version": 1})
+        if probe is None:
+            # Not cached: the document may be mid-write or about to be
+            # configured, and a cached {} would turn every chat turn into
+            # NOT_CONFIGURED_REPLY for the whole TTL
+            self.config = {}
+            self.version = None
+            self.checked_at = None
+        elif probe.get("version") is None or probe["version"] != self.version:
+            # Unversioned documents predate the cache, so always reload them
+            self.reloads += 1
+            config = await db.n8n_config.find_one({}, {"_id": 0})
+            self._store(config or {}, (config or {}).get("version"))
+        else:
+            self.checked_at = time.monotonic()
+
+    def _store(self, config: dict, version: Optional[str]):
+        # Replies cached under another config may no longer be right. Purging
+        # the reply cache also bumps the version, so every worker drops its
+        # copy within one TTL.
+        if version != self.version and reply_cache is not None:
+            reply_cache.clear()
+        self.config = config
+        self.version = version
+        self.checked_at = time.monotonic()
+
+    def set(self, config: dict):
+        """Write-through update after the config document has been replaced"""
+        self._store(dict(config), config.get("version"))
+
+    def invalidate(self):
+        self.checked_at = None
+
+    def stats(self) -> dict:
+        return {
+            "ttl_seconds": self.ttl,
+            "version": self.version,
+            "hits": self.hits,
+            "refreshes": self.refreshes,
+            "reloads": self.reloads,
+        }
+
+
+n8n_config_cache = N8nConfigCache(N8N_CONFIG_TTL)
+
+
+class TTLCache:
+    """Size-bounded LRU cache whose entries also expire after a TTL"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+# Chat session cache
+# Sessions never change after create_chat_session, so lookups are served from
+# memory. Unknown IDs are remembered briefly as well so that a flood of bad
+# session IDs does not turn into a flood of Mongo queries.
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', '10000'))
+SESSION_CACHE_TTL = float(os.environ.get('SESSION_CACHE_TTL', '3600'))
+SESSION_CACHE_NEGATIVE_TTL = float(os.environ.get('SESSION_CACHE_NEGATIVE_TTL', '5'))
+
+_SESSION_NOT_FOUND = object()
+session_cache = TTLCache(SESSION_CACHE_SIZE, SESSION_CACHE_TTL)
+
+
+async def get_chat_session(session_id: str) -> Optional[dict]:
+    """Look up a chat session document, going to Mongo only on a cache miss"""
+    cached = session_cache.get(session_id)
+    if cached is _SESSION_NOT_FOUND:
+        return None
+    if cached is not None:
+        return cached
+    session = await db.chat_sessions.find_one({"id": session_id}, {"_id": 0})
+    if session is None:
+        session_cache.set(session_id, _SESSION_NOT_FOUND, ttl=SESSION_CACHE_NEGATIVE_TTL)
+        return None
+    session_cache.set(session_id, session)
+    return session
+
+# n8n reply cache
+# Opt-in cache of bot replies for FAQ-style questions (pricing, menus, booking).
+# Messages are keyed by a normalized form: case-folded with punctuation removed
+# and whitespace collapsed. N8N_REPLY_CACHE_KEY may name a "module:function"
+# that takes the message and returns a key, or None to bypass the cache, for
+# smarter similarity matching. Only successful n8n replies are cached.
+# The key ignores who is asking, so this is only safe for workflows whose
+# replies do not depend on the user or the conversation. As a guard, replies
+# that mention the session's user name or email are never cached, and short
+# context-dependent messages ("yes", "how much?") bypass the cache.
+N8N_REPLY_CACHE = os.environ.get('N8N_REPLY_CACHE', 'false').lower() in ('1', 'true', 'yes')
+N8N_REPLY_CACHE_SIZE = int(os.environ.get('N8N_REPLY_CACHE_SIZE', '1000'))
+N8N_REPLY_CACHE_TTL = float(os.environ.get('N8N_REPLY_CACHE_TTL', '3600'))
+N8N_REPLY_CACHE_KEY = os.environ.get('N8N_REPLY_CACHE_KEY', '')
+N8N_REPLY_CACHE_MIN_WORDS = int(os.environ.get('N8N_REPLY_CACHE_MIN_WORDS', '3'))
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_message(message: str) -> Optional[str]:
+    """Default reply cache key: case-folded text without punctuation or extra whitespace"""
+    key = _WHITESPACE_RE.sub(" ", _PUNCTUATION_RE.sub("", message.casefold())).strip()
+    return key or None
+
+
+def load_reply_cache_key_func():
+    if not N8N_REPLY_CACHE_KEY:
+        return normalize_message
+    module_name, _, attr = N8N_REPLY_CACHE_KEY.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+reply_cache = TTLCache(N8N_REPLY_CACHE_SIZE, N8N_REPLY_CACHE_TTL) if N8N_REPLY_CACHE else None
+reply_cache_key_func = load_reply_cache_key_func() if N8N_REPLY_CACHE else normalize_message
+
+
+def reply_cache_key(message: str) -> Optional[str]:
+    """Cache key for a message, or None when the reply cache should not be used"""
+    if reply_cache is None or len(message.split()) < N8N_REPLY_CACHE_MIN_WORDS:
+        return None
+    return reply_cache_key_func(message)
+
+
+def is_shareable_reply(session: dict, reply: str) -> bool:
+    """False for replies personalised for this session's user, which must not be cached"""
+    for value in (session.get("user_name"), session.get("user_email")):
+        value = (value or "").strip()
+        # Single letters would match ordinary words
+        if len(value) > 1 and re.search(rf"\b{re.escape(value)}\b", reply, re.IGNORECASE):
+            return False
+    return True
+
+# MongoDB indexes
+# Every index the API's queries rely on, as (collection, keys, options).
+# ensure_indexes() creates any that are missing on startup; it is idempotent.
+ENSURE_INDEXES_ON_STARTUP = os.environ.get('ENSURE_INDEXES_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
+
+INDEX_SPECS = [
+    ("chat_messages", [("session_id", 1), ("timestamp", 1), ("id", 1)], {"name": "session_id_timestamp_id"}),
+    ("chat_messages", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("chat_messages", [("session_id", 1), ("idempotency_key", 1)], {
+        "name": "session_id_idempotency_key",
+        "partialFilterExpression": {"idempotency_key": {"$exists": True}},
+    }),
+    ("chat_sessions", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("status_checks", [("timestamp", 1), ("id", 1)], {"name": "timestamp_id"}),
+]
+
+# Indexes, as (collection, name), that earlier versions created but that no
+# query needs any more; ensure_indexes() drops them to save their write cost
+UNUSED_INDEXES = []
+
+# Representative shapes of the queries issued by the routes, used to verify
+# through explain() that none of them falls back to a collection scan.
+INDEXED_QUERIES = [
+    ("chat_sessions", {"id": ""}, None),
+    ("chat_messages", {"id": ""}, None),
+    ("chat_messages", {"session_id": ""}, [("timestamp", 1), ("id", 1)]),
+    ("chat_messages", {"session_id": ""}, [("timestamp", -1), ("id", -1)]),
+    ("status_checks", {}, [("timestamp", 1), ("id", 1)]),
+]
+
+
+def retention_index(collection: str, field: str, days: float) -> tuple:
+    """Spec for an index on a date field that expires documents after `days` (0 keeps them)"""
+    options = {"name": field}
+    if days > 0:
+        options["expireAfterSeconds"] = int(days * 86400)
+    return collection, [(field, 1)], options
+
+
+def _find_index(existing: dict, keys: list, options: dict) -> Optional[str]:
+    for name, info in existing.items():
+        if list(info["key"]) == keys and bool(info.get("unique")) == bool(options.get("unique")):
+            return name
+    return None
+
+
+async def ensure_indexes() -> List[str]:
+    """Create any missing indexes from INDEX_SPECS and return their names"""
+    created = []
+    for collection, keys, options in INDEX_SPECS:
+        try:
+            existing = await db[collection].index_information()
+            name = _find_index(existing, keys, options)
+            if name:
+                ttl = options.get("expireAfterSeconds")
+                if existing[name].get("expireAfterSeconds") == ttl:
+                    continue
+                if ttl is not None:
+                    await db.command("collMod", collection, index={"name": name, "expireAfterSeconds": ttl})
+                    logger.info(f"Changed expiry of index {name} on {collection} to {ttl}s")
+                    continue
+                # Retention was switched off; an expiry cannot be removed in place
+                await db[collection].drop_index(name)
+                logger.info(f"Dropped expiring index {name} on {collection}")
+            name = await db[collection].create_index(keys, **options)
+            created.append(f"{collection}.{name}")
+            logger.info(f"Created index {name} on {collection}")
+        except PyMongoError as e:
+            logger.error(f"Could not create index {options['name']} on {collection}: {e}")
+    for collection, name in UNUSED_INDEXES:
+        try:
+            if name in await db[collection].index_information():
+                await db[collection].drop_index(name)
+                logger.info(f"Dropped unused index {name} on {collection}")
+        except PyMongoError as e:
+            logger.error(f"Could not drop index {name} on {collection}: {e}")
+    return created
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    # Newer servers wrap the classic plan in a "queryPlan" document
+    plan = plan.get("queryPlan", plan)
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(_plan_stages(child))
+    return stages
+
+
+async def check_indexes() -> dict:
+    """Report missing indexes and route queries that still need a collection scan"""
+    missing = []
+    for collection, keys, options in INDEX_SPECS:
+        existing = await db[collection].index_information()
+        if not _find_index(existing, keys, options):
+            missing.append({"collection": collection, "name": options["name"], "keys": keys})
+    collection_scans = []
+    for collection, query, sort in INDEXED_QUERIES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        explain = await cursor.explain()
+        stages = _plan_stages(explain["queryPlanner"]["winningPlan"])
+        if "COLLSCAN" in stages:
+            collection_scans.append({"collection": collection, "query": query, "sort": sort, "stages": stages})
+    return {"ok": not missing and not collection_scans, "missing": missing, "collection_scans": collection_scans}
+
+# History pagination
+# List endpoints page through documents in (timestamp, id) order. The cursor
+# is the sort key of the last document returned, so each page is a single
+# index range scan no matter how deep into the history it starts.
+HISTORY_MAX_LIMIT = 1000
+HISTORY_STREAM_BATCH_SIZE = 200
+KEYSET_SORT = [("timestamp", 1), ("id", 1)]
+
+# List endpoints serialize the stored documents straight to JSON instead of
+# building a model per document, so they project exactly the public fields
+CHAT_MESSAGE_PROJECTION = {"_id": 0, "id": 1, "session_id": 1, "message": 1, "sender": 1, "timestamp": 1}
+STATUS_CHECK_PROJECTION = {"_id": 0, "id": 1, "client_name": 1, "timestamp": 1}
+
+
+def encode_cursor(doc: dict) -> str:
+    raw = json.dumps([doc["timestamp"].isoformat(), doc["id"]]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        timestamp, doc_id = json.loads(raw)
+        return datetime.fromisoformat(timestamp), str(doc_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def keyset_query(query: dict, after: Optional[str]) -> dict:
+    """Restrict a query to documents that sort after the given cursor"""
+    if not after:
+        return query
+    timestamp, doc_id = decode_cursor(after)
+    return {
+        **query,
+        "$or": [
+            {"timestamp": {"$gt": timestamp}},
+            {"timestamp": timestamp, "id": {"$gt": doc_id}},
+        ],
+    }
+
+
+async def fetch_page(collection, query: dict, projection: dict, limit: int, after: Optional[str]) -> tuple:
+    """Return up to `limit` documents after the cursor and the cursor for the next page"""
+    # Fetch one extra document to learn whether another page exists
+    cursor = collection.find(keyset_query(query, after), projection).sort(KEYSET_SORT).limit(limit + 1)
+    docs = await cursor.to_list(limit + 1)
+    if len(docs) > limit:
+        return docs[:limit], encode_cursor(docs[limit - 1])
+    return docs, None
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dump_json(value) -> bytes:
+    """Serialize to compact JSON bytes, with orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_json_default, separators=(",", ":")).encode()
+
+
+def json_bytes_response(value, headers: Optional[dict] = None) -> Response:
+    return Response(dump_json(value), media_type="application/json", headers=headers)
+
+
+def stream_ndjson(collection, query: dict, projection: dict, limit: Optional[int], after: Optional[str]) -> StreamingResponse:
+    """Stream matching documents as NDJSON straight from the Motor cursor"""
+    cursor = collection.find(keyset_query(query, after), projection).sort(KEYSET_SORT)
+    cursor = cursor.batch_size(HISTORY_STREAM_BATCH_SIZE)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    async def lines():
+        async for doc in cursor:
+            yield dump_json(doc) + b"\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# Chat message storage
+# By default every chat message is its own document in chat_messages. With
+# CHAT_STORAGE=buckets a session's messages are appended with an atomic $push
+# to bucket documents in chat_message_buckets holding up to CHAT_BUCKET_SIZE
+# messages each, so a history read is a handful of document fetches. Two
+# appends racing to open a bucket may both create one; readers merge buckets
+# by (timestamp, id), so that only costs a little space.
+# Retention is enforced with TTL indexes: messages (or whole buckets, once
+# their newest message is old enough) and sessions expire after the given
+# number of days. With 0 they are kept forever and the same fields get plain
+# indexes, which the analytics date-range queries use either way.
+CHAT_STORAGE = os.environ.get('CHAT_STORAGE', 'documents').lower()
+CHAT_BUCKETED = CHAT_STORAGE == 'buckets'
+CHAT_BUCKET_SIZE = int(os.environ.get('CHAT_BUCKET_SIZE', '50'))
+CHAT_MESSAGE_RETENTION_DAYS = float(os.environ.get('CHAT_MESSAGE_RETENTION_DAYS', '0'))
+CHAT_SESSION_RETENTION_DAYS = float(os.environ.get('CHAT_SESSION_RETENTION_DAYS', '0'))
+
+CHAT_MESSAGE_FIELDS = [field for field in CHAT_MESSAGE_PROJECTION if field != "_id"]
+
+if CHAT_BUCKETED:
+    INDEX_SPECS += [
+        ("chat_message_buckets", [("session_id", 1), ("first_timestamp", 1)], {"name": "session_id_first_timestamp"}),
+        ("chat_message_buckets", [("session_id", 1), ("last_timestamp", 1)], {"name": "session_id_last_timestamp"}),
+        ("chat_message_buckets", [("messages.id", 1)], {"name": "messages_id"}),
+    ]
+    INDEXED_QUERIES += [
+        ("chat_message_buckets", {"messages.id": ""}, None),
+        ("chat_message_buckets", {"session_id": ""}, [("first_timestamp", 1)]),
+        ("chat_message_buckets", {"session_id": ""}, [("last_timestamp", -1)]),
+    ]
+
+RETENTION_INDEXES = [
+    ("chat_messages", "timestamp", CHAT_MESSAGE_RETENTION_DAYS),
+    ("chat_sessions", "created_at", CHAT_SESSION_RETENTION_DAYS),
+] + ([("chat_message_buckets", "last_timestamp", CHAT_MESSAGE_RETENTION_DAYS)] if CHAT_BUCKETED else [])
+
+for _collection, _field, _days in RETENTION_INDEXES:
+    INDEX_SPECS.append(retention_index(_collection, _field, _days))
+    INDEXED_QUERIES.append((_collection, {_field: {"$gte": datetime.min}}, None))
+
+
+def public_message(doc: dict) -> dict:
+    return {field: doc[field] for field in CHAT_MESSAGE_FIELDS}
+
+
+def _sort_key(doc: dict) -> tuple:
+    return doc["timestamp"], doc["id"]
+
+
+def _bucket_update(docs: List[dict]) -> UpdateOne:
+    """Append `docs` (all from one session) to an open bucket, opening one if needed"""
+    timestamps = [doc["timestamp"] for doc in docs]
+    return UpdateOne(
+        {
+            "session_id": docs[0]["session_id"],
+            "count": {"$lte": CHAT_BUCKET_SIZE - len(docs)},
+            # Buckets written by migrate_to_buckets are replaced when it runs again
+            "migrated_at": {"$exists": False},
+        },
+        {
+            "$push": {"messages": {"$each": docs, "$sort": {"timestamp": 1, "id": 1}}},
+            "$inc": {"count": len(docs)},
+            "$min": {"first_timestamp": min(timestamps)},
+            "$max": {"last_timestamp": max(timestamps)},
+        },
+        upsert=True,
+    )
+
+
+async def store_chat_messages(docs: List[dict]):
+    """Write chat messages with a single round trip in either storage mode"""
+    if not CHAT_BUCKETED:
+        if len(docs) == 1:
+            await db.chat_messages.insert_one(docs[0])
+        else:
+            await db.chat_messages.insert_many(docs, ordered=False)
+        return
+    by_session: dict = {}
+    for doc in docs:
+        by_session.setdefault(doc["session_id"], []).append(doc)
+    updates = []
+    for session_docs in by_session.values():
+        for start in range(0, len(session_docs), CHAT_BUCKET_SIZE):
+            updates.append(_bucket_update(session_docs[start:start + CHAT_BUCKET_SIZE]))
+    await db.chat_message_buckets.bulk_write(updates, ordered=False)
+
+
+async def find_chat_message(query: dict) -> Optional[dict]:
+    """Find one message matching a flat query on message fields, e.g. {"id": ...}"""
+    if not CHAT_BUCKETED:
+        return await db.chat_messages.find_one(query, CHAT_MESSAGE_PROJECTION)
+    element = {field: value for field, value in query.items() if field != "session_id"}
+    bucket_query = {"messages": {"$elemMatch": element}}
+    if "session_id" in query:
+        bucket_query["session_id"] = query["session_id"]
+    bucket = await db.chat_message_buckets.find_one(
+        bucket_query, {"_id": 0, "messages": {"$elemMatch": element}}
+    )
+    return public_message(bucket["messages"][0]) if bucket else None
+
+
+async def iter_bucketed_messages(session_id: str, since: Optional[datetime], after: Optional[str]):
+    """Yield a session's messages from its buckets in (timestamp, id) order"""
+    bucket_query = {"session_id": session_id}
+    lower = None
+    if after:
+        lower = decode_cursor(after)
+        bucket_query["last_timestamp"] = {"$gte": lower[0]}
+    if since is not None:
+        bucket_query["last_timestamp"] = {"$gt": max(since, lower[0]) if lower else since}
+
+    def wanted(doc: dict) -> bool:
+        if since is not None and doc["timestamp"] <= since:
+            return False
+        return lower is None or _sort_key(doc) > lower
+
+    cursor = db.chat_message_buckets.find(bucket_query, {"_id": 0, "first_timestamp": 1, "messages": 1})
+    cursor = cursor.sort("first_timestamp", 1).batch_size(HISTORY_STREAM_BATCH_SIZE // CHAT_BUCKET_SIZE + 1)
+    # Buckets arrive in order of their oldest message, so everything pending
+    # that is older than the next bucket's oldest message can be released
+    pending: List[dict] = []
+    async for bucket in cursor:
+        ready = bisect.bisect_left(pending, bucket["first_timestamp"], key=lambda doc: doc["timestamp"])
+        for doc in pending[:ready]:
+            yield doc
+        pending = sorted(
+            pending[ready:] + [public_message(doc) for doc in bucket["messages"] if wanted(doc)], key=_sort_key
+        )
+    for doc in pending:
+        yield doc
+
+
+async def fetch_chat_page(session_id: str, limit: int, after: Optional[str], since: Optional[datetime] = None) -> tuple:
+    """fetch_page() over a session's messages in either storage mode"""
+    if not CHAT_BUCKETED:
+        query = {"session_id": session_id}
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        return await fetch_page(db.chat_messages, query, CHAT_MESSAGE_PROJECTION, limit, after)
+    docs = []
+    async with aclosing(iter_bucketed_messages(session_id, since, after)) as messages:
+        async for doc in messages:
+            docs.append(doc)
+            if len(docs) > limit:
+                break
+    if len(docs) > limit:
+        return docs[:limit], encode_cursor(docs[limit - 1])
+    return docs, None
+
+
+def stream_chat_history(session_id: str, limit: Optional[int], after: Optional[str], since: Optional[datetime] = None) -> StreamingResponse:
+    """stream_ndjson() over a session's messages in either storage mode"""
+    if not CHAT_BUCKETED:
+        query = {"session_id": session_id}
+        if since is not None:
+            query["timestamp"] = {"$gt": since}
+        return stream_ndjson(db.chat_messages, query, CHAT_MESSAGE_PROJECTION, limit, after)
+
+    async def lines():
+        sent = 0
+        async with aclosing(iter_bucketed_messages(session_id, since, after)) as messages:
+            async for doc in messages:
+                yield dump_json(doc) + b"\n"
+                sent += 1
+                if limit and sent >= limit:
+                    break
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+async def migrate_to_buckets(delete_source: bool = False) -> dict:
+    """Copy chat_messages into buckets, session by session
+
+    Buckets from an earlier run are replaced, so the migration can be repeated
+    until traffic has been switched over to CHAT_STORAGE=buckets. Messages in
+    those buckets are carried over, since with `delete_source` their
+    chat_messages documents are already gone.
+    """
+    run_at = datetime.utcnow()
+    report = {"sessions": 0, "messages": 0, "buckets": 0, "deleted": 0}
+    sessions = db.chat_messages.aggregate([{"$group": {"_id": "$session_id"}}], allowDiskUse=True)
+    async for group in sessions:
+        session_id = group["_id"]
+        messages = await db.chat_messages.find({"session_id": session_id}, {"_id": 0}).sort(KEYSET_SORT).to_list(None)
+        previous = await db.chat_message_buckets.find(
+            {"session_id": session_id, "migrated_at": {"$exists": True}}, {"_id": 1, "messages": 1}
+        ).to_list(None)
+        # The source documents win over earlier copies of the same message
+        merged = {doc["id"]: doc for bucket in previous for doc in bucket["messages"]}
+        merged.update((doc["id"], doc) for doc in messages)
+        ordered = sorted(merged.values(), key=_sort_key)
+        buckets = [
+            {
+                "session_id": session_id,
+                "messages": chunk,
+                "count": len(chunk),
+                "first_timestamp": chunk[0]["timestamp"],
+                "last_timestamp": chunk[-1]["timestamp"],
+                "migrated_at": run_at,
+            }
+            for chunk in (ordered[i:i + CHAT_BUCKET_SIZE] for i in range(0, len(ordered), CHAT_BUCKET_SIZE))
+        ]
+        if buckets:
+            await db.chat_message_buckets.insert_many(buckets)
+        if previous:
+            await db.chat_message_buckets.delete_many({"_id": {"$in": [bucket["_id"] for bucket in previous]}})
+        if delete_source and messages:
+            result = await db.chat_messages.delete_many({"id": {"$in": [doc["id"] for doc in messages]}})
+            report["deleted"] += result.deleted_count
+        report["sessions"] += 1
+        report["messages"] += len(messages)
+        report["buckets"] += len(buckets)
+    return report
+
+# Chat message write-behind
+# With CHAT_WRITE_BEHIND enabled, chat messages are queued by the request
+# handlers and written by a background task with one store_chat_messages call
+# per batch, either when a batch fills up or when the flush interval elapses.
+# The queue is drained on shutdown. CHAT_SYNC_USER_MESSAGES keeps user
+# messages on the synchronous path so they are durable before the n8n call.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+CHAT_SYNC_USER_MESSAGES = os.environ.get('CHAT_SYNC_USER_MESSAGES', 'false').lower() in ('1', 'true', 'yes')
+CHAT_WRITE_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BATCH_SIZE', '100'))
+CHAT_WRITE_FLUSH_INTERVAL = float(os.environ.get('CHAT_WRITE_FLUSH_INTERVAL', '0.05'))
+CHAT_WRITE_QUEUE_SIZE = int(os.environ.get('CHAT_WRITE_QUEUE_SIZE', '10000'))
+
+_STOP_WRITER = object()
+
+
+class MessageWriter:
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self.enqueued = 0
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def put(self, doc: dict):
+        """Queue a document for writing, waiting only if the queue is full"""
+        self.enqueued += 1
+        await self.queue.put(doc)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            doc = await self.queue.get()
+            if doc is _STOP_WRITER:
+                break
+            batch = [doc]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    doc = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if doc is _STOP_WRITER:
+                    stopping = True
+                    break
+                batch.append(doc)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[dict]):
+        try:
+            await store_chat_messages(batch)
+            self.written += len(batch)
+            self.batches += 1
+        except PyMongoError as e:
+            self.failed += len(batch)
+            logger.error(f"Failed to write {len(batch)} queued chat message(s): {e}")
+
+    async def stop(self):
+        """Flush everything still queued and stop the background task"""
+        if self._task is None:
+            return
+        # The sentinel is queued behind all pending documents, so they are
+        # written before the task exits
+        await self.queue.put(_STOP_WRITER)
+        await self._task
+        self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "sync_user_messages": CHAT_SYNC_USER_MESSAGES,
+            "queued": self.queue.qsize(),
+            "enqueued": self.enqueued,
+            "written": self.written,
+            "batches": self.batches,
+            "failed": self.failed,
+        }
+
+
+message_writer: Optional[MessageWriter] = None
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -36,6 +1272,10 @@ class StatusCheck(BaseModel):
 class StatusCheckCreate(BaseModel):
     client_name: str
 
+class StatusCheckPage(BaseModel):
+    items: List[StatusCheck]
+    next_cursor: Optional[str] = None
+
 # Chatbot Models
 class ChatSession(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
@@ -54,9 +1294,20 @@ class ChatMessage(BaseModel):
     sender: str  # "user" or "bot"
     timestamp: datetime = Field(default_factory=datetime.utcnow)
 
+class ChatMessagePage(BaseModel):
+    items: List[ChatMessage]
+    next_cursor: Optional[str] = None
+
+class ChatMessageAccepted(BaseModel):
+    status: str = "pending"
+    user_message: ChatMessage
+    bot_message_id: str
+
 class ChatMessageSend(BaseModel):
     session_id: str
     message: str
+    # Optional client-generated ID; resending the same ID returns the stored reply
+    client_message_id: Optional[str] = None
 
 class N8nConfig(BaseModel):
     webhook_url: Optional[str] = None
@@ -64,22 +1315,752 @@ class N8nConfig(BaseModel):
 class N8nConfigUpdate(BaseModel):
     webhook_url: str
 
+# n8n chat turn helpers
+FALLBACK_REPLY = "I apologize, but I'm having trouble processing your request right now. Please try again later."
+NOT_CONFIGURED_REPLY = "The chatbot is not fully configured yet. Please contact the administrator to set up the n8n webhook URL."
+# Stand-in replies sent when n8n could not answer
+DEGRADED_REPLIES = (FALLBACK_REPLY, NOT_CONFIGURED_REPLY)
+
+
+def build_n8n_payload(session: dict, message: str) -> dict:
+    return {
+        "session_id": session.get("id"),
+        "user_name": session.get("user_name"),
+        "user_email": session.get("user_email"),
+        "message": message,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+
+def parse_n8n_reply(n8n_response) -> str:
+    # Assuming n8n returns {"response": "bot message"} or similar
+    # Adjust this based on your n8n workflow output
+    return n8n_response.get("response") or n8n_response.get("message") or str(n8n_response)
+
+
+async def get_bot_reply(session: dict, message: str) -> str:
+    """Run the n8n workflow for a user message and return the bot's reply text"""
+    # Get n8n webhook URL
+    with timed("config"):
+        config = await n8n_config_cache.get()
+    webhook_url = config.get("webhook_url")
+    if not webhook_url:
+        # No webhook configured - return default message
+        return NOT_CONFIGURED_REPLY
+    cache_key = reply_cache_key(message)
+    if cache_key:
+        cached = reply_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    try:
+        # Send to n8n workflow
+        with timed("n8n"):
+            reply = parse_n8n_reply(await call_n8n(webhook_url, build_n8n_payload(session, message)))
+        if cache_key and is_shareable_reply(session, reply):
+            reply_cache.set(cache_key, reply)
+        return reply
+    except N8nUnavailable as e:
+        logger.warning(f"Skipping n8n webhook call: {e}", extra={"event": "n8n_call_skipped"})
+        return FALLBACK_REPLY
+    except httpx.HTTPError as e:
+        logger.error(f"Error calling n8n webhook: {e}")
+        return FALLBACK_REPLY
+    except Exception as e:
+        logger.error(f"Unexpected error with n8n: {e}")
+        return FALLBACK_REPLY
+
+
+async def _iter_n8n_stream(response: httpx.Response):
+    # n8n's streaming response mode emits one JSON object per line, e.g.
+    # {"type": "item", "content": "..."}. Plain text bodies are relayed as they
+    # arrive; anything else is buffered and parsed as a regular JSON reply.
+    if response.headers.get("content-type", "").startswith("text/plain"):
+        async for text in response.aiter_text():
+            if text:
+                yield text
+        return
+    buffered = []
+    streamed = False
+    async for line in response.aiter_lines():
+        try:
+            item = json.loads(line)
+        except ValueError:
+            item = None
+        if isinstance(item, dict) and item.get("type") in ("begin", "item", "end", "error"):
+            streamed = True
+            if item["type"] == "error":
+                raise ValueError(f"n8n stream error: {item.get('content')}")
+            if item["type"] == "item" and item.get("content"):
+                yield item["content"]
+        elif not streamed:
+            buffered.append(line)
+    if not streamed:
+        body = "\n".join(buffered)
+        try:
+            yield parse_n8n_reply(json.loads(body))
+        except ValueError:
+            yield body
+
+
+async def stream_bot_reply(session: dict, message: str):
+    """Like get_bot_reply, but yield the reply in chunks as n8n produces them"""
+    with timed("config"):
+        config = await n8n_config_cache.get()
+    webhook_url = config.get("webhook_url")
+    if not webhook_url:
+        yield NOT_CONFIGURED_REPLY
+        return
+    cache_key = reply_cache_key(message)
+    if cache_key:
+        cached = reply_cache.get(cache_key)
+        if cached is not None:
+            yield cached
+            return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + N8N_LATENCY_BUDGET
+    sent_any = False
+    chunks = []
+    try:
+        with timed("n8n"):
+            async with n8n_call_slot():
+                n8n_pool_stats["requests"] += 1
+                start = time.perf_counter()
+                try:
+                    # The budget is applied to each read rather than around the
+                    # yields, so it can never cancel the code consuming the chunks
+                    request = http_client.build_request(
+                        "POST",
+                        webhook_url,
+                        json=build_n8n_payload(session, message),
+                        extensions={"trace": _trace_n8n_connection},
+                    )
+                    async with asyncio.timeout_at(deadline):
+                        response = await http_client.send(request, stream=True)
+                    try:
+                        response.raise_for_status()
+                        async with aclosing(_iter_n8n_stream(response)) as stream:
+                            while True:
+                                async with asyncio.timeout_at(deadline):
+                                    chunk = await anext(stream, None)
+                                if chunk is None:
+                                    break
+                                sent_any = True
+                                chunks.append(chunk)
+                                yield chunk
+                    finally:
+                        await response.aclose()
+                except TimeoutError:
+                    n8n_resilience_stats["budget_exceeded"] += 1
+                    error = httpx.TimeoutException(f"n8n stream exceeded the {N8N_LATENCY_BUDGET}s latency budget")
+                    observe_n8n_call(start, error)
+                    n8n_breaker.record_failure()
+                    raise error
+                except Exception as e:
+                    observe_n8n_call(start, e)
+                    n8n_breaker.record_failure()
+                    raise
+                except BaseException:
+                    # The client went away mid-stream, which says nothing about n8n
+                    n8n_breaker.release()
+                    raise
+                observe_n8n_call(start, status_code=response.status_code)
+                n8n_breaker.record_success()
+        if cache_key and chunks and is_shareable_reply(session, "".join(chunks)):
+            reply_cache.set(cache_key, "".join(chunks))
+    except N8nUnavailable as e:
+        logger.warning(f"Skipping n8n webhook call: {e}", extra={"event": "n8n_call_skipped"})
+        yield FALLBACK_REPLY
+    except Exception as e:
+        logger.error(f"Error streaming from n8n webhook: {e}")
+        # Keep whatever already reached the user, otherwise apologise
+        if not sent_any:
+            yield FALLBACK_REPLY
+
+
+async def save_chat_message(message: ChatMessage, durable: bool = False, idempotency_key: Optional[str] = None):
+    """Persist a chat message, through the write-behind queue unless `durable`"""
+    doc = message.dict()
+    if idempotency_key:
+        doc["idempotency_key"] = idempotency_key
+    if message_writer is None or durable:
+        await store_chat_messages([doc])
+    else:
+        await message_writer.put(doc)
+
+# Idempotent chat turns
+# A message sent with an Idempotency-Key header (or client_message_id) is
+# processed at most once per session within IDEMPOTENCY_WINDOW seconds: repeats
+# get the stored bot reply, and duplicates that arrive while the first request
+# is still waiting on n8n share its result instead of starting another run.
+# This covers the plain, streamed and WebSocket sends; async sends are keyed
+# on their job marker instead (see record_chat_job).
+IDEMPOTENCY_WINDOW = float(os.environ.get('IDEMPOTENCY_WINDOW', '86400'))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '10000'))
+
+idempotent_replies = TTLCache(IDEMPOTENCY_CACHE_SIZE, IDEMPOTENCY_WINDOW)
+idempotent_in_flight: dict = {}
+idempotency_stats = {"replayed": 0, "coalesced": 0}
+
+
+async def find_idempotent_reply(session_id: str, key: str) -> Optional[ChatMessage]:
+    """Look for a reply stored by this or another worker within the window"""
+    doc = await find_chat_message({
+        "session_id": session_id,
+        "idempotency_key": key,
+        "sender": "bot",
+        "timestamp": {"$gte": datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_WINDOW)},
+    })
+    return ChatMessage(**doc) if doc else None
+
+
+async def run_idempotent_turn(session_id: str, key: str, run) -> ChatMessage:
+    """Run `run()` once per (session, key), sharing the result with duplicates"""
+    scope = (session_id, key)
+    cached = idempotent_replies.get(scope)
+    if cached is not None:
+        idempotency_stats["replayed"] += 1
+        return cached
+    in_flight = idempotent_in_flight.get(scope)
+    if in_flight is not None:
+        idempotency_stats["coalesced"] += 1
+        # Shield so a duplicate giving up does not cancel the original call
+        return await asyncio.shield(in_flight)
+
+    future = asyncio.get_running_loop().create_future()
+    idempotent_in_flight[scope] = future
+    try:
+        result = await find_idempotent_reply(session_id, key)
+        if result is not None:
+            idempotency_stats["replayed"] += 1
+        else:
+            result = await run()
+        # An apology is shared with concurrent duplicates but not replayed
+        # later, so a retry after n8n recovers runs the workflow again
+        if result.message not in DEGRADED_REPLIES:
+            idempotent_replies.set(scope, result)
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        if isinstance(e, asyncio.CancelledError):
+            future.cancel()
+        else:
+            future.set_exception(e)
+            # Mark the exception as retrieved when no duplicate was waiting
+            future.exception()
+        raise
+    finally:
+        idempotent_in_flight.pop(scope, None)
+
+
+# Streamed replies still being read from n8n, so shutdown can let them finish
+stream_reply_tasks: set = set()
+_STREAM_DONE = object()
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=_json_default)}\n\n"
+
+# Asynchronous chat turns
+# POST /chat/message/async hands the n8n call to a fixed pool of background
+# workers and returns immediately. The queue is bounded so that a slow n8n
+# results in early 503s rather than an ever-growing backlog. Finished replies
+# are kept in memory for a while so polling does not depend on write-behind.
+# Jobs only exist in the memory of the uvicorn worker that accepted them, so
+# each one also gets a marker in chat_jobs: a poll that lands on another
+# worker finds it there and answers 202 rather than 404. Markers expire
+# CHAT_JOB_RESULT_TTL seconds after their last update.
+CHAT_JOB_CONCURRENCY = int(os.environ.get('CHAT_JOB_CONCURRENCY', '8'))
+CHAT_JOB_QUEUE_SIZE = int(os.environ.get('CHAT_JOB_QUEUE_SIZE', '100'))
+CHAT_JOB_RESULT_TTL = float(os.environ.get('CHAT_JOB_RESULT_TTL', '300'))
+CHAT_JOB_MAX_WAIT = float(os.environ.get('CHAT_JOB_MAX_WAIT', '30'))
+CHAT_JOB_SHUTDOWN_TIMEOUT = float(os.environ.get('CHAT_JOB_SHUTDOWN_TIMEOUT', '10'))
+
+INDEX_SPECS += [
+    ("chat_jobs", [("id", 1)], {"name": "id_unique", "unique": True}),
+    ("chat_jobs", [("session_id", 1), ("idempotency_key", 1)], {
+        "name": "session_id_idempotency_key_unique",
+        "unique": True,
+        "partialFilterExpression": {"idempotency_key": {"$exists": True}},
+    }),
+    retention_index("chat_jobs", "updated_at", CHAT_JOB_RESULT_TTL / 86400),
+]
+INDEXED_QUERIES += [
+    ("chat_jobs", {"id": ""}, None),
+    ("chat_jobs", {"session_id": "", "idempotency_key": ""}, None),
+]
+
+
+async def record_chat_job(bot_message_id: str, user_message: ChatMessage, idempotency_key: Optional[str] = None) -> Optional[dict]:
+    """Store the pending marker for a job before it is queued
+
+    With an idempotency key the marker also claims the key: when a concurrent
+    duplicate got there first, its marker is returned and nothing is stored.
+    """
+    now = datetime.utcnow()
+    job = {
+        "id": bot_message_id,
+        "session_id": user_message.session_id,
+        "user_message": user_message.dict(),
+        "status": "pending",
+        "created_at": now,
+        "updated_at": now,
+    }
+    if idempotency_key:
+        job["idempotency_key"] = idempotency_key
+    try:
+        await db.chat_jobs.insert_one(job)
+    except DuplicateKeyError:
+        return await find_keyed_chat_job(user_message.session_id, idempotency_key)
+    return None
+
+
+async def find_keyed_chat_job(session_id: str, key: str) -> Optional[dict]:
+    return await db.chat_jobs.find_one({"session_id": session_id, "idempotency_key": key}, {"_id": 0})
+
+
+async def finish_chat_job(bot_message_id: str, status: str, release_key: bool = False):
+    """Mark a job "done" or "failed"; the reply itself is in the chat history
+
+    `release_key` frees the job's idempotency key, so a retry runs again.
+    """
+    update = {"$set": {"status": status, "updated_at": datetime.utcnow()}}
+    if release_key:
+        update["$unset"] = {"idempotency_key": ""}
+    try:
+        await db.chat_jobs.update_one({"id": bot_message_id}, update)
+    except PyMongoError as e:
+        logger.error(f"Could not mark chat job {bot_message_id} as {status}: {e}")
+
+
+async def is_chat_job_pending(bot_message_id: str) -> bool:
+    """Whether any worker has a reply for this ID still coming
+
+    A "done" job counts too, as its reply may still be in a write-behind queue.
+    """
+    job = await db.chat_jobs.find_one({"id": bot_message_id}, {"_id": 0, "status": 1})
+    return job is not None and job["status"] != "failed"
+
+
+class ChatJobPool:
+    def __init__(self, concurrency: int, max_queue: int, result_ttl: float):
+        self.concurrency = concurrency
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self.pending: dict = {}
+        self.results = TTLCache(max(max_queue, 1000), result_ttl)
+        self._workers: List[asyncio.Task] = []
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    def _reject(self):
+        self.rejected += 1
+        raise HTTPException(
+            status_code=503,
+            detail="Too many pending chat messages, please retry shortly",
+            headers={"Retry-After": "1"},
+        )
+
+    def reserve(self):
+        """Raise 503 straight away when the queue is full, before anything is saved"""
+        if self.queue.full():
+            self._reject()
+
+    def submit(self, session: dict, message: str, bot_message_id: str, idempotency_key: Optional[str] = None):
+        """Queue a chat turn, raising 503 when the queue is full"""
+        try:
+            self.queue.put_nowait((session, message, bot_message_id, idempotency_key))
+        except asyncio.QueueFull:
+            self._reject()
+        self.pending[bot_message_id] = asyncio.Event()
+        self.submitted += 1
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            if job is None:
+                return
+            session, message, bot_message_id, idempotency_key = job
+            status, degraded = "failed", True
+            try:
+                bot_message = ChatMessage(
+                    id=bot_message_id,
+                    session_id=session["id"],
+                    message=await get_bot_reply(session, message),
+                    sender="bot"
+                )
+                self.results.set(bot_message_id, bot_message)
+                # Only real replies are tagged, so a retry after an apology runs again
+                degraded = bot_message.message in DEGRADED_REPLIES
+                await save_chat_message(bot_message, idempotency_key=None if degraded else idempotency_key)
+                warm_up.record_chat_turn(bot_message.message)
+                self.completed += 1
+                status = "done"
+            except Exception as e:
+                logger.error(f"Chat job {bot_message_id} failed: {e}")
+            finally:
+                event = self.pending.pop(bot_message_id, None)
+                if event is not None:
+                    event.set()
+            await finish_chat_job(bot_message_id, status, release_key=bool(idempotency_key) and degraded)
+
+    async def wait_for(self, bot_message_id: str, timeout: float) -> Optional[ChatMessage]:
+        """Return the finished reply, waiting up to `timeout` seconds if it is still pending"""
+        event = self.pending.get(bot_message_id)
+        if event is not None and timeout > 0:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.results.get(bot_message_id)
+
+    def is_pending(self, bot_message_id: str) -> bool:
+        return bot_message_id in self.pending
+
+    async def stop(self, timeout: float):
+        """Let queued jobs finish for up to `timeout` seconds, then cancel the workers"""
+        # Never wait for queue space here: workers that get no sentinel keep
+        # draining jobs until the timeout and are then cancelled
+        for _ in self._workers:
+            try:
+                self.queue.put_nowait(None)
+            except asyncio.QueueFull:
+                break
+        done, not_done = await asyncio.wait(self._workers, timeout=timeout)
+        for task in not_done:
+            task.cancel()
+        if not_done:
+            logger.warning(f"Cancelled {len(not_done)} chat worker(s) with {self.queue.qsize()} job(s) still queued")
+        self._workers = []
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "queue_size": self.queue.maxsize,
+            "queued": self.queue.qsize(),
+            "in_progress": len(self.pending) - self.queue.qsize(),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+
+chat_job_pool = ChatJobPool(CHAT_JOB_CONCURRENCY, CHAT_JOB_QUEUE_SIZE, CHAT_JOB_RESULT_TTL)
+
+# Chat analytics
+# Time series for dashboards, computed by aggregation pipelines that hand back
+# one document per group, so the API's work grows with the number of hours in
+# the range rather than the number of messages. Ranges are widened to whole
+# hours, which also lets repeated dashboard refreshes share a cached result.
+ANALYTICS_CACHE_TTL = float(os.environ.get('ANALYTICS_CACHE_TTL', '60'))
+ANALYTICS_MAX_RANGE_DAYS = float(os.environ.get('ANALYTICS_MAX_RANGE_DAYS', '92'))
+ANALYTICS_DEFAULT_RANGE_DAYS = 7
+
+analytics_cache = TTLCache(128, ANALYTICS_CACHE_TTL)
+
+
+def naive_utc(value: datetime) -> datetime:
+    """Convert to the naive UTC datetimes stored in MongoDB"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def analytics_range(start: Optional[datetime], end: Optional[datetime]) -> tuple:
+    end = naive_utc(end) if end else datetime.utcnow()
+    start = naive_utc(start) if start else end - timedelta(days=ANALYTICS_DEFAULT_RANGE_DAYS)
+    start = start.replace(minute=0, second=0, microsecond=0)
+    hour = end.replace(minute=0, second=0, microsecond=0)
+    end = hour if hour == end else hour + timedelta(hours=1)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    if end - start > timedelta(days=ANALYTICS_MAX_RANGE_DAYS):
+        raise HTTPException(status_code=400, detail=f"Range is limited to {ANALYTICS_MAX_RANGE_DAYS:g} days")
+    return start, end
+
+
+def message_analytics_pipeline(start: datetime, end: datetime) -> list:
+    pipeline = []
+    if CHAT_BUCKETED:
+        pipeline += [
+            {"$match": {"last_timestamp": {"$gte": start}, "first_timestamp": {"$lt": end}}},
+            {"$unwind": "$messages"},
+            {"$replaceRoot": {"newRoot": "$messages"}},
+        ]
+    return pipeline + [
+        {"$match": {"timestamp": {"$gte": start, "$lt": end}}},
+        {"$group": {
+            "_id": {
+                "hour": {"$dateToString": {"format": "%Y-%m-%dT%H:00:00", "date": "$timestamp"}},
+                "sender": "$sender",
+                "fallback": {"$and": [
+                    {"$eq": ["$sender", "bot"]},
+                    {"$in": ["$message", list(DEGRADED_REPLIES)]},
+                ]},
+            },
+            "count": {"$sum": 1},
+        }},
+    ]
+
+
+async def compute_chat_analytics(start: datetime, end: datetime) -> dict:
+    collection = db.chat_message_buckets if CHAT_BUCKETED else db.chat_messages
+    hours: dict = {}
+    async for group in collection.aggregate(message_analytics_pipeline(start, end), allowDiskUse=True):
+        key = group["_id"]
+        hour = hours.setdefault(key["hour"], {"hour": key["hour"], "user": 0, "bot": 0, "fallback": 0})
+        hour[key["sender"]] = hour.get(key["sender"], 0) + group["count"]
+        if key["fallback"]:
+            hour["fallback"] += group["count"]
+    messages_per_hour = [hours[hour] for hour in sorted(hours)]
+
+    sessions = db.chat_sessions.aggregate([
+        {"$match": {"created_at": {"$gte": start, "$lt": end}}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}}, "sessions": {"$sum": 1}}},
+        {"$sort": {"_id": 1}},
+    ])
+    sessions_per_day = [{"day": group["_id"], "sessions": group["sessions"]} async for group in sessions]
+
+    bot_replies = sum(hour["bot"] for hour in messages_per_hour)
+    fallback = sum(hour["fallback"] for hour in messages_per_hour)
+    return {
+        "start": start,
+        "end": end,
+        "messages_per_hour": messages_per_hour,
+        "sessions_per_day": sessions_per_day,
+        "fallback_replies": {
+            "bot_replies": bot_replies,
+            "fallback": fallback,
+            "share": round(fallback / bot_replies, 4) if bot_replies else 0.0,
+        },
+    }
+
+# Status check rollups
+# Uptime pings arrive every few seconds, so create_status_check also bumps a
+# per-minute and a per-hour counter for the client with an upsert, and
+# GET /status/rollups reads those instead of raw rows. Raw rows can be bounded
+# with a TTL (STATUS_CHECK_RETENTION_DAYS) or, when the collection does not
+# exist yet, by creating it as a capped collection (STATUS_CHECK_CAPPED_MB).
+# Capped collections cannot have TTL indexes, so the cap wins when both are set.
+STATUS_CHECK_RETENTION_DAYS = float(os.environ.get('STATUS_CHECK_RETENTION_DAYS', '0'))
+STATUS_CHECK_CAPPED_MB = float(os.environ.get('STATUS_CHECK_CAPPED_MB', '0'))
+STATUS_MINUTE_ROLLUP_RETENTION_DAYS = float(os.environ.get('STATUS_MINUTE_ROLLUP_RETENTION_DAYS', '7'))
+STATUS_HOUR_ROLLUP_RETENTION_DAYS = float(os.environ.get('STATUS_HOUR_ROLLUP_RETENTION_DAYS', '0'))
+STATUS_ROLLUP_MAX_POINTS = 10000
+
+# Granularity -> (collection, truncation, default range, retention in days)
+STATUS_ROLLUPS = {
+    "minute": ("status_rollups_minute", lambda ts: ts.replace(second=0, microsecond=0),
+               timedelta(hours=1), STATUS_MINUTE_ROLLUP_RETENTION_DAYS),
+    "hour": ("status_rollups_hour", lambda ts: ts.replace(minute=0, second=0, microsecond=0),
+             timedelta(days=7), STATUS_HOUR_ROLLUP_RETENTION_DAYS),
+}
+
+# timestamp_id serves every query on status_checks, so the single-field index
+# only exists to carry the TTL
+if STATUS_CHECK_RETENTION_DAYS > 0 and STATUS_CHECK_CAPPED_MB <= 0:
+    INDEX_SPECS.append(retention_index("status_checks", "timestamp", STATUS_CHECK_RETENTION_DAYS))
+else:
+    UNUSED_INDEXES.append(("status_checks", "timestamp"))
+for _collection, _, _, _days in STATUS_ROLLUPS.values():
+    INDEX_SPECS += [
+        (_collection, [("period", 1), ("client_name", 1)], {"name": "period_client_name_unique", "unique": True}),
+        retention_index(_collection, "period", _days),
+    ]
+    INDEXED_QUERIES.append((_collection, {"period": {"$gte": datetime.min}}, [("period", 1), ("client_name", 1)]))
+
+
+async def ensure_status_collection():
+    """Create status_checks as a capped collection when STATUS_CHECK_CAPPED_MB is set"""
+    if STATUS_CHECK_CAPPED_MB <= 0:
+        return
+    size = int(STATUS_CHECK_CAPPED_MB * 1024 * 1024)
+    try:
+        if not await db.list_collection_names(filter={"name": "status_checks"}):
+            await db.create_collection("status_checks", capped=True, size=size)
+            logger.info(f"Created capped status_checks collection of {size} bytes")
+        elif not (await db.status_checks.options()).get("capped"):
+            # Converting locks the database and rewrites the data, so leave it to an operator
+            logger.warning(
+                "status_checks already exists and is not capped; convert it with "
+                f'db.runCommand({{convertToCapped: "status_checks", size: {size}}})'
+            )
+    except PyMongoError as e:
+        logger.error(f"Could not create capped status_checks collection: {e}")
+
+
+async def record_status_rollups(client_name: str, timestamp: datetime):
+    await asyncio.gather(*(
+        db[collection].update_one(
+            {"period": truncate(timestamp), "client_name": client_name},
+            {"$inc": {"count": 1}},
+            upsert=True,
+        )
+        for collection, truncate, _, _ in STATUS_ROLLUPS.values()
+    ))
+
+# Startup warm-up and readiness
+# The first requests after a restart would otherwise pay for opening MongoDB
+# connections, loading the n8n config and the TLS handshake with n8n. A
+# background task does that work as soon as the server is up, and /api/ready
+# answers 503 until it has finished so the platform holds traffic back. The
+# time from process start to the first successful chat turn is recorded too.
+WARMUP_N8N_CONNECTION = os.environ.get('WARMUP_N8N_CONNECTION', 'true').lower() in ('1', 'true', 'yes')
+WARMUP_RETRY_INTERVAL = float(os.environ.get('WARMUP_RETRY_INTERVAL', '2'))
+
+PROCESS_STARTED = time.monotonic()
+
+
+def _ms_since_start() -> float:
+    return round((time.monotonic() - PROCESS_STARTED) * 1000, 1)
+
+
+class WarmUp:
+    def __init__(self):
+        self.ready = False
+        self.ready_after_ms: Optional[float] = None
+        self.first_chat_turn_ms: Optional[float] = None
+        self.steps: dict = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    async def _step(self, name: str, run):
+        start = time.perf_counter()
+        await run()
+        self.steps[name] = round((time.perf_counter() - start) * 1000, 1)
+
+    async def _run(self):
+        # The instance is no use without MongoDB, so stay unready until it answers
+        while True:
+            try:
+                await self._step("mongo_ping", lambda: db.command("ping"))
+                await self._step("n8n_config", n8n_config_cache.get)
+                break
+            except PyMongoError as e:
+                logger.warning(f"Warm-up is waiting for MongoDB: {e}", extra={"event": "warmup_retry"})
+                await asyncio.sleep(WARMUP_RETRY_INTERVAL)
+        if WARMUP_N8N_CONNECTION:
+            await self._open_n8n_connection()
+        self.ready = True
+        self.ready_after_ms = _ms_since_start()
+        logger.info(
+            f"Warm-up complete {self.ready_after_ms:.0f} ms after start",
+            extra={"event": "warmup_complete", "steps": self.steps},
+        )
+
+    async def _open_n8n_connection(self):
+        webhook_url = (await n8n_config_cache.get()).get("webhook_url")
+        if not webhook_url or http_client is None:
+            return
+        try:
+            # OPTIONS sets up the pooled connection without running the workflow
+            await self._step("n8n_connection", lambda: http_client.request("OPTIONS", webhook_url))
+        except Exception as e:
+            # Only an optimisation; the first chat turn will connect instead
+            logger.warning(f"Could not pre-open the n8n connection: {e}")
+
+    def record_chat_turn(self, reply: str):
+        """Note the first chat turn that got a real reply from n8n"""
+        if self.first_chat_turn_ms is None and reply not in DEGRADED_REPLIES:
+            self.first_chat_turn_ms = _ms_since_start()
+            logger.info(
+                f"First successful chat turn {self.first_chat_turn_ms:.0f} ms after start",
+                extra={"event": "first_chat_turn"},
+            )
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "ready_after_ms": self.ready_after_ms,
+            "first_chat_turn_ms": self.first_chat_turn_ms,
+            "steps": dict(self.steps),
+        }
+
+
+warm_up = WarmUp()
+
 # Add your routes to the router instead of directly to app
 @api_router.get("/")
 async def root():
     return {"message": "Hello World"}
 
+@api_router.get("/ready")
+async def readiness():
+    """Readiness probe: 503 until the startup warm-up has finished"""
+    return JSONResponse(
+        status_code=200 if warm_up.ready else 503,
+        content=warm_up.stats(),
+        headers={"Cache-Control": "no-store"},
+    )
+
 @api_router.post("/status", response_model=StatusCheck)
 async def create_status_check(input: StatusCheckCreate):
     status_dict = input.dict()
     status_obj = StatusCheck(**status_dict)
-    _ = await db.status_checks.insert_one(status_obj.dict())
+    await asyncio.gather(
+        db.status_checks.insert_one(status_obj.dict()),
+        record_status_rollups(status_obj.client_name, status_obj.timestamp),
+    )
     return status_obj
 
-@api_router.get("/status", response_model=List[StatusCheck])
-async def get_status_checks():
-    status_checks = await db.status_checks.find().to_list(1000)
-    return [StatusCheck(**status_check) for status_check in status_checks]
+@api_router.get("/status", response_model=Union[StatusCheckPage, List[StatusCheck]])
+async def get_status_checks(
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_LIMIT),
+    after: Optional[str] = None,
+    stream: bool = False,
+):
+    """List status checks, as a page when `limit`/`after` are given or as NDJSON with `stream`"""
+    if stream:
+        return stream_ndjson(db.status_checks, {}, STATUS_CHECK_PROJECTION, limit, after)
+    status_checks, next_cursor = await fetch_page(
+        db.status_checks, {}, STATUS_CHECK_PROJECTION, limit or HISTORY_MAX_LIMIT, after
+    )
+    if limit is None and after is None:
+        # Plain list for existing clients; the header tells them it was truncated
+        return json_bytes_response(status_checks, {"X-Next-Cursor": next_cursor} if next_cursor else None)
+    return json_bytes_response({"items": status_checks, "next_cursor": next_cursor})
+
+@api_router.get("/status/rollups")
+async def get_status_rollups(
+    granularity: Literal["minute", "hour"] = "hour",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    client_name: Optional[str] = None,
+):
+    """Status check counts per client and minute or hour
+
+    The range defaults to the last hour for minutes and the last 7 days for hours.
+    """
+    collection, truncate, default_range, _ = STATUS_ROLLUPS[granularity]
+    end = naive_utc(end) if end else datetime.utcnow()
+    start = truncate(naive_utc(start) if start else end - default_range)
+    if end <= start:
+        raise HTTPException(status_code=400, detail="end must be after start")
+    query = {"period": {"$gte": start, "$lt": end}}
+    if client_name is not None:
+        query["client_name"] = client_name
+    cursor = db[collection].find(query, {"_id": 0, "period": 1, "client_name": 1, "count": 1})
+    items = await cursor.sort([("period", 1), ("client_name", 1)]).to_list(STATUS_ROLLUP_MAX_POINTS + 1)
+    return json_bytes_response({
+        "granularity": granularity,
+        "start": start,
+        "end": end,
+        "items": items[:STATUS_ROLLUP_MAX_POINTS],
+        "truncated": len(items) > STATUS_ROLLUP_MAX_POINTS,
+    })
 
 # Chatbot Routes
 @api_router.post("/chat/session", response_model=ChatSession)
@@ -87,102 +2068,597 @@ async def create_chat_session(session_data: ChatSessionCreate):
     """Create a new chat session with user information"""
     session = ChatSession(**session_data.dict())
     await db.chat_sessions.insert_one(session.dict())
-    logger.info(f"Created chat session: {session.id} for {session.user_email}")
+    session_cache.set(session.id, session.dict())
+    logger.info("Created chat session", extra={"event": "chat_session_created", "session_id": session.id})
     return session
 
+async def process_chat_turn(session: dict, message: str, idempotency_key: Optional[str] = None) -> ChatMessage:
+    """Save the user message, get the bot's reply from n8n and save that too"""
+    # Save user message
+    user_message = ChatMessage(
+        session_id=session["id"],
+        message=message,
+        sender="user"
+    )
+    with timed("user_insert"):
+        await save_chat_message(user_message, durable=CHAT_SYNC_USER_MESSAGES, idempotency_key=idempotency_key)
+    
+    bot_response_text = await get_bot_reply(session, message)
+    
+    # Save bot response
+    bot_message = ChatMessage(
+        session_id=session["id"],
+        message=bot_response_text,
+        sender="bot"
+    )
+    # Only real replies are tagged, so find_idempotent_reply never replays an apology
+    if bot_response_text in DEGRADED_REPLIES:
+        idempotency_key = None
+    with timed("bot_insert"):
+        await save_chat_message(bot_message, idempotency_key=idempotency_key)
+    warm_up.record_chat_turn(bot_message.message)
+    
+    return bot_message
+
 @api_router.post("/chat/message", response_model=ChatMessage)
-async def send_chat_message(message_data: ChatMessageSend):
-    """Send a message to n8n workflow and return the response"""
+async def send_chat_message(
+    message_data: ChatMessageSend,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """Send a message to n8n workflow and return the response
+
+    Resending with the same Idempotency-Key header or client_message_id returns
+    the original reply instead of running the workflow again.
+    """
     # Verify session exists
-    session = await db.chat_sessions.find_one({"id": message_data.session_id})
+    with timed("session"):
+        session = await get_chat_session(message_data.session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Chat session not found")
     
-    # Save user message
+    key = idempotency_key or message_data.client_message_id
+    if key:
+        return await run_idempotent_turn(
+            message_data.session_id, key, lambda: process_chat_turn(session, message_data.message, key)
+        )
+    return await process_chat_turn(session, message_data.message)
+
+@api_router.post("/chat/message/stream")
+async def stream_chat_message(
+    message_data: ChatMessageSend,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """Send a message to n8n and relay the reply as Server-Sent Events
+
+    Emits a `start` event with the message IDs, one `token` event per chunk of
+    the reply (a single one when n8n does not stream) and a final `done` event
+    carrying the saved bot message. Resending with the same Idempotency-Key
+    header or client_message_id replays the original reply as a single `token`;
+    its `start` event has `replayed` set and no user message ID.
+    """
+    with timed("session"):
+        session = await get_chat_session(message_data.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+    key = idempotency_key or message_data.client_message_id
     user_message = ChatMessage(
         session_id=message_data.session_id,
         message=message_data.message,
         sender="user"
     )
-    await db.chat_messages.insert_one(user_message.dict())
-    
-    # Get n8n webhook URL
-    config = await db.n8n_config.find_one({})
-    webhook_url = config.get("webhook_url") if config else None
-    
-    bot_response_text = ""
-    
-    if webhook_url:
+    bot_message = ChatMessage(session_id=message_data.session_id, message="", sender="bot")
+
+    # n8n is read and the reply saved by a task of its own: Starlette cancels
+    # the response body when the client goes away, and the reply must still
+    # end up in the history. The SSE generator only relays the events.
+    events_queue: asyncio.Queue = asyncio.Queue()
+
+    async def produce() -> ChatMessage:
+        with timed("user_insert"):
+            await save_chat_message(user_message, durable=CHAT_SYNC_USER_MESSAGES, idempotency_key=key)
+        events_queue.put_nowait(sse_event("start", {"user_message_id": user_message.id, "bot_message_id": bot_message.id}))
+        parts = []
+        async for chunk in stream_bot_reply(session, message_data.message):
+            parts.append(chunk)
+            events_queue.put_nowait(sse_event("token", {"text": chunk}))
+        bot_message.message = "".join(parts)
+        bot_message.timestamp = datetime.utcnow()
+        # Only real replies are tagged, so find_idempotent_reply never replays an apology
+        bot_key = None if bot_message.message in DEGRADED_REPLIES else key
+        with timed("bot_insert"):
+            await save_chat_message(bot_message, idempotency_key=bot_key)
+        warm_up.record_chat_turn(bot_message.message)
+        return bot_message
+
+    async def run():
         try:
-            # Send to n8n workflow
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    webhook_url,
-                    json={
-                        "session_id": message_data.session_id,
-                        "user_name": session.get("user_name"),
-                        "user_email": session.get("user_email"),
-                        "message": message_data.message,
-                        "timestamp": datetime.utcnow().isoformat()
-                    }
-                )
-                response.raise_for_status()
-                
-                # Parse n8n response
-                n8n_response = response.json()
-                # Assuming n8n returns {"response": "bot message"} or similar
-                # Adjust this based on your n8n workflow output
-                bot_response_text = n8n_response.get("response") or n8n_response.get("message") or str(n8n_response)
-                
-        except httpx.HTTPError as e:
-            logger.error(f"Error calling n8n webhook: {e}")
-            bot_response_text = "I apologize, but I'm having trouble processing your request right now. Please try again later."
+            if key:
+                result = await run_idempotent_turn(message_data.session_id, key, produce)
+            else:
+                result = await produce()
+            if result is not bot_message:
+                events_queue.put_nowait(sse_event(
+                    "start", {"user_message_id": None, "bot_message_id": result.id, "replayed": True}
+                ))
+                events_queue.put_nowait(sse_event("token", {"text": result.message}))
+            events_queue.put_nowait(sse_event("done", result.dict()))
         except Exception as e:
-            logger.error(f"Unexpected error with n8n: {e}")
-            bot_response_text = "I apologize, but I'm having trouble processing your request right now. Please try again later."
-    else:
-        # No webhook configured - return default message
-        bot_response_text = "The chatbot is not fully configured yet. Please contact the administrator to set up the n8n webhook URL."
-    
-    # Save bot response
-    bot_message = ChatMessage(
+            logger.error(f"Could not complete streamed chat reply {bot_message.id}: {e}")
+            events_queue.put_nowait(sse_event("error", {"detail": "The reply could not be saved"}))
+        finally:
+            events_queue.put_nowait(_STREAM_DONE)
+
+    task = asyncio.create_task(run())
+    stream_reply_tasks.add(task)
+    task.add_done_callback(stream_reply_tasks.discard)
+
+    async def events():
+        while (event := await events_queue.get()) is not _STREAM_DONE:
+            yield event
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def accepted_chat_job(job: dict) -> ChatMessageAccepted:
+    return ChatMessageAccepted(
+        status=job["status"], user_message=ChatMessage(**job["user_message"]), bot_message_id=job["id"]
+    )
+
+
+async def find_accepted_chat_job(session_id: str, key: str) -> Optional[ChatMessageAccepted]:
+    """An earlier send with this key, from its job marker or, once that has expired, the history"""
+    job = await find_keyed_chat_job(session_id, key)
+    if job is not None:
+        return accepted_chat_job(job)
+    bot_message = await find_idempotent_reply(session_id, key)
+    if bot_message is None:
+        return None
+    user_message = await find_chat_message({"session_id": session_id, "idempotency_key": key, "sender": "user"})
+    if user_message is None:
+        return None
+    return ChatMessageAccepted(status="done", user_message=ChatMessage(**user_message), bot_message_id=bot_message.id)
+
+
+@api_router.post("/chat/message/async", response_model=ChatMessageAccepted, status_code=202)
+async def send_chat_message_async(
+    message_data: ChatMessageSend,
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
+    """Accept a message and run the n8n workflow in the background
+
+    The reply is fetched later from GET /chat/message/{bot_message_id}.
+    Resending with the same Idempotency-Key header or client_message_id
+    returns the original job instead of queueing another one.
+    """
+    session = await get_chat_session(message_data.session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+    key = idempotency_key or message_data.client_message_id
+    if key:
+        accepted = await find_accepted_chat_job(message_data.session_id, key)
+        if accepted is not None:
+            idempotency_stats["replayed"] += 1
+            return accepted
+
+    user_message = ChatMessage(
         session_id=message_data.session_id,
-        message=bot_response_text,
-        sender="bot"
+        message=message_data.message,
+        sender="user"
     )
-    await db.chat_messages.insert_one(bot_message.dict())
-    
-    return bot_message
+    bot_message_id = str(uuid.uuid4())
+    # Reject before saving anything when the worker queue is already full. The
+    # pending marker claims the idempotency key, and the turn is queued only
+    # once the user message it answers has been saved, so a worker cannot
+    # finish the job first
+    chat_job_pool.reserve()
+    existing = await record_chat_job(bot_message_id, user_message, key)
+    if existing is not None:
+        idempotency_stats["coalesced"] += 1
+        return accepted_chat_job(existing)
+    try:
+        await save_chat_message(user_message, durable=CHAT_SYNC_USER_MESSAGES, idempotency_key=key)
+        chat_job_pool.submit(session, message_data.message, bot_message_id, key)
+    except Exception:
+        await db.chat_jobs.delete_one({"id": bot_message_id})
+        raise
+    return ChatMessageAccepted(user_message=user_message, bot_message_id=bot_message_id)
+
+@api_router.get("/chat/message/{message_id}", response_model=ChatMessage)
+async def get_chat_message(
+    message_id: str,
+    wait: float = Query(0, ge=0, le=CHAT_JOB_MAX_WAIT),
+):
+    """Fetch a single message, long-polling up to `wait` seconds for a pending reply
+
+    Only the worker running the job can long-poll; the others answer 202 at once.
+    """
+    result = await chat_job_pool.wait_for(message_id, wait)
+    if result is not None:
+        return result
+    if not chat_job_pool.is_pending(message_id):
+        message = await find_chat_message({"id": message_id})
+        if message:
+            return ChatMessage(**message)
+        if not await is_chat_job_pending(message_id):
+            raise HTTPException(status_code=404, detail="Message not found")
+    return JSONResponse(status_code=202, content={"status": "pending", "id": message_id}, headers={"Retry-After": "1"})
+
+async def history_etag(session_id: str, variant: str) -> str:
+    """Weak ETag for a session's history from its newest message, found with one index probe"""
+    if CHAT_BUCKETED:
+        # Every append bumps the count of the bucket holding the newest message
+        latest = await db.chat_message_buckets.find_one(
+            {"session_id": session_id}, {"_id": 1, "count": 1}, sort=[("last_timestamp", -1)]
+        )
+        version = f"{latest['_id']}.{latest['count']}" if latest else "empty"
+    else:
+        latest = await db.chat_messages.find_one(
+            {"session_id": session_id},
+            {"_id": 0, "id": 1, "timestamp": 1},
+            sort=[("timestamp", -1), ("id", -1)],
+        )
+        version = f"{latest['id']}.{latest['timestamp'].isoformat()}" if latest else "empty"
+    # Different query parameters are different representations of the history
+    digest = hashlib.sha1(f"{version}|{variant}".encode()).hexdigest()[:16]
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    # Weak comparison: W/"x" and "x" name the same representation
+    return "*" in candidates or etag.removeprefix("W/") in [tag.removeprefix("W/") for tag in candidates]
+
+
+def parse_since(since: str) -> Optional[datetime]:
+    try:
+        return naive_utc(datetime.fromisoformat(since))
+    except ValueError:
+        return None
+
+@api_router.get("/chat/messages/{session_id}", response_model=Union[ChatMessagePage, List[ChatMessage]])
+async def get_chat_messages(
+    session_id: str,
+    request: Request,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_LIMIT),
+    after: Optional[str] = None,
+    since: Optional[str] = None,
+    stream: bool = False,
+    if_none_match: Optional[str] = Header(None, alias="If-None-Match"),
+):
+    """Get the messages for a chat session, paginated with `limit`/`after` or streamed as NDJSON
+
+    `since` returns only messages newer than an ISO timestamp or a message ID.
+    Responses carry an ETag; sending it back in If-None-Match gets a 304 when
+    nothing has been added since.
+    """
+    paged = limit is not None or after is not None
+    since_timestamp = None
+    if since:
+        since_timestamp = parse_since(since)
+        if since_timestamp is None and after is None:
+            # An unknown message ID falls back to the full history
+            seen = await find_chat_message({"id": since, "session_id": session_id})
+            after = encode_cursor(seen) if seen else None
+    if stream:
+        return stream_chat_history(session_id, limit, after, since_timestamp)
+
+    etag = await history_etag(session_id, str(request.query_params))
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    messages, next_cursor = await fetch_chat_page(session_id, limit or HISTORY_MAX_LIMIT, after, since_timestamp)
+    if not paged:
+        # Plain list for the chat widget; the header tells it the history was truncated
+        if next_cursor:
+            headers["X-Next-Cursor"] = next_cursor
+        return json_bytes_response(messages, headers)
+    return json_bytes_response({"items": messages, "next_cursor": next_cursor}, headers)
+
+# WebSocket chat transport
+WS_MAX_IN_FLIGHT = int(os.environ.get('WS_MAX_IN_FLIGHT', '4'))
 
-@api_router.get("/chat/messages/{session_id}", response_model=List[ChatMessage])
-async def get_chat_messages(session_id: str):
-    """Get all messages for a chat session"""
-    messages = await db.chat_messages.find({"session_id": session_id}).sort("timestamp", 1).to_list(1000)
-    return [ChatMessage(**msg) for msg in messages]
+
+@api_router.websocket("/chat/ws/{session_id}")
+async def chat_websocket(websocket: WebSocket, session_id: str, last_seen: Optional[str] = None):
+    """Persistent chat connection bound to one session
+
+    On connect, messages after `last_seen` (or the whole history when it is not
+    given) are sent first. Clients then send {"message": ..., "client_message_id": ...}
+    and receive {"type": "message", "data": <bot message>} for each reply, pushed
+    as soon as it is ready, so several messages can be in flight at once.
+    """
+    await websocket.accept()
+    session = await get_chat_session(session_id)
+    if not session:
+        await websocket.close(code=4404, reason="Chat session not found")
+        return
+
+    send_lock = asyncio.Lock()
+
+    async def push(payload: dict):
+        async with send_lock:
+            await websocket.send_text(dump_json(payload).decode())
+
+    # Resume from the last message the client has seen
+    after = None
+    if last_seen:
+        seen = await find_chat_message({"id": last_seen, "session_id": session_id})
+        after = encode_cursor(seen) if seen else None
+    while True:
+        missed, after = await fetch_chat_page(session_id, HISTORY_MAX_LIMIT, after)
+        for doc in missed:
+            await push({"type": "message", "data": doc})
+        if after is None:
+            break
+
+    in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    tasks = set()
+
+    async def handle(message: str, key: Optional[str]):
+        try:
+            if key:
+                bot_message = await run_idempotent_turn(session_id, key, lambda: process_chat_turn(session, message, key))
+            else:
+                bot_message = await process_chat_turn(session, message)
+            await push({"type": "message", "data": bot_message.dict(), "client_message_id": key})
+        except Exception as e:
+            # The reply is already saved; the client will get it when it resumes
+            logger.warning(
+                f"Could not deliver chat reply over WebSocket: {e}",
+                extra={"event": "ws_delivery_failed", "session_id": session_id},
+            )
+        finally:
+            in_flight.release()
+
+    try:
+        while True:
+            payload = await websocket.receive_json()
+            message = payload.get("message") if isinstance(payload, dict) else None
+            if not isinstance(message, str) or not message:
+                await push({"type": "error", "detail": "Expected {\"message\": \"...\"}"})
+                continue
+            await in_flight.acquire()
+            task = asyncio.create_task(handle(message, payload.get("client_message_id")))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    except ValueError:
+        await websocket.close(code=1003, reason="Expected JSON messages")
 
 @api_router.get("/chat/config", response_model=N8nConfig)
 async def get_n8n_config():
     """Get the current n8n webhook configuration"""
-    config = await db.n8n_config.find_one({})
-    if config:
-        return N8nConfig(webhook_url=config.get("webhook_url"))
-    return N8nConfig(webhook_url=None)
+    config = await n8n_config_cache.get()
+    return N8nConfig(webhook_url=config.get("webhook_url"))
 
 @api_router.put("/chat/config")
 async def update_n8n_config(config_data: N8nConfigUpdate):
     """Update the n8n webhook URL"""
-    # Delete existing config and insert new one
-    await db.n8n_config.delete_many({})
-    await db.n8n_config.insert_one({"webhook_url": config_data.webhook_url})
+    # Replace the single config document in one write, so other workers never
+    # see it missing. The version lets them notice the change without
+    # reloading the document on every check.
+    config = {
+        "webhook_url": config_data.webhook_url,
+        "version": uuid.uuid4().hex,
+        "updated_at": datetime.utcnow(),
+    }
+    await db.n8n_config.replace_one({}, dict(config), upsert=True)
+    # Also drops replies cached from the old workflow
+    n8n_config_cache.set(config)
     logger.info("Updated n8n webhook URL")
     return {"message": "Configuration updated successfully", "webhook_url": config_data.webhook_url}
 
+# Analytics Routes
+@api_router.get("/analytics/chat")
+async def get_chat_analytics(start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """Messages per hour, sessions per day and the share of fallback replies
+
+    The range defaults to the last 7 days and is widened to whole hours.
+    Results are cached for ANALYTICS_CACHE_TTL seconds.
+    """
+    start, end = analytics_range(start, end)
+    result = analytics_cache.get((start, end))
+    if result is None:
+        with timed("analytics"):
+            result = await compute_chat_analytics(start, end)
+        analytics_cache.set((start, end), result)
+    return json_bytes_response(result)
+
+# Admin Routes
+@api_router.get("/admin/stats")
+async def get_admin_stats():
+    """Report runtime statistics for connection pools and caches"""
+    return {
+        "n8n_pool": get_n8n_pool_stats(),
+        "n8n_resilience": get_n8n_resilience_stats(),
+        "n8n_config_cache": n8n_config_cache.stats(),
+        "session_cache": session_cache.stats(),
+        "reply_cache": reply_cache.stats() if reply_cache is not None else {"enabled": False},
+        "message_writer": message_writer.stats() if message_writer else {"enabled": False},
+        "chat_jobs": chat_job_pool.stats(),
+        "analytics_cache": analytics_cache.stats(),
+        "logging": get_logging_stats(),
+        "warm_up": warm_up.stats(),
+        "idempotency": {
+            "cached_replies": len(idempotent_replies),
+            "in_flight": len(idempotent_in_flight),
+            **idempotency_stats,
+        },
+    }
+
+@api_router.delete("/admin/reply-cache")
+async def purge_reply_cache():
+    """Drop all cached n8n replies, e.g. after the workflow has changed"""
+    if reply_cache is None:
+        return {"message": "Reply cache is disabled", "purged": 0}
+    purged = len(reply_cache)
+    # Other workers clear their caches when they next see the new version
+    config = await db.n8n_config.find_one_and_update(
+        {}, {"$set": {"version": uuid.uuid4().hex}},
+        projection={"_id": 0}, return_document=ReturnDocument.AFTER,
+    )
+    if config is None:
+        reply_cache.clear()
+    else:
+        n8n_config_cache.set(config)
+    logger.info(f"Purged {purged} cached n8n replies")
+    return {"message": "Reply cache purged", "purged": purged}
+
+@api_router.get("/admin/indexes")
+async def get_index_report():
+    """Check that every index the API relies on exists and is used"""
+    return await check_indexes()
+
 # Configure logging (before routes that use logger)
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Nothing is written from the event loop: handlers put records on a bounded
+# queue and a QueueListener thread formats and writes them. When the queue is
+# full the record is dropped and counted rather than blocking the request.
+# Records can carry an `event` name and structured fields through `extra`;
+# LOG_SAMPLE_RATES keeps only a fraction of the records for the named events,
+# e.g. "chat_session_created=0.1,n8n_call_skipped=0.01". Records without an
+# event are matched by logger name instead, e.g. "uvicorn.access=0.1,httpx=0".
+# Errors are never sampled.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+
+
+def parse_sample_rates(raw: str) -> tuple:
+    """Parse "event=rate,..." into a dict, returning the entries that could not be parsed too"""
+    rates, invalid = {}, []
+    for item in filter(None, (item.strip() for item in raw.split(","))):
+        event, _, rate = item.partition("=")
+        try:
+            rates[event.strip()] = float(rate)
+        except ValueError:
+            invalid.append(item)
+    return rates, invalid
+
+
+LOG_SAMPLE_RATES, _invalid_sample_rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+
+# Attributes every LogRecord has; anything else was passed through `extra`
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "color_message"}
+
+
+def _record_extras(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _LOG_RECORD_FIELDS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(_record_extras(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The classic one-line format, with the `extra` fields appended as key=value"""
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        line = super().formatMessage(record)
+        fields = " ".join(f"{key}={json.dumps(value, default=str)}" for key, value in _record_extras(record).items())
+        return f"{line} {fields}" if fields else line
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+        self.sampled_out: dict = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Access logs and library chatter have no event, so go by logger name
+        event = getattr(record, "event", None) or record.name
+        rate = self.rates.get(event)
+        if rate is None or record.levelno >= logging.ERROR or random.random() < rate:
+            return True
+        self.sampled_out[event] = self.sampled_out.get(event, 0) + 1
+        return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Render the message and traceback now, since args may change before the
+        # listener gets to them, but leave the formatting to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            ERRORS.inc(("logging", "queue_full"))
+
+
+class LogListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Wait for room instead of failing when the queue is full at shutdown
+        self.queue.put(self._sentinel)
+
+
+def get_logging_stats() -> dict:
+    return {
+        "format": LOG_FORMAT,
+        "queue_size": LOG_QUEUE_SIZE,
+        "queued": log_queue.qsize(),
+        "dropped": log_handler.dropped,
+        "sampled_out": dict(log_sampler.sampled_out),
+    }
+
+
+log_queue: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+log_sampler = SamplingFilter(LOG_SAMPLE_RATES)
+log_handler = DroppingQueueHandler(log_queue)
+log_handler.addFilter(log_sampler)
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(
+    JsonFormatter() if LOG_FORMAT == "json"
+    else TextFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 )
+log_listener = LogListener(log_queue, _log_output)
+logging.basicConfig(level=LOG_LEVEL, handlers=[log_handler])
+# uvicorn installs its own stream handlers before importing the app; send its
+# access and error lines through the queue as well
+for _name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+    logging.getLogger(_name).handlers = [log_handler]
+    logging.getLogger(_name).propagate = False
+log_listener.start()
+# Write out whatever is still queued when the process exits
+atexit.register(log_listener.stop)
+
 logger = logging.getLogger(__name__)
+slow_logger = logging.getLogger(f"{__name__}.slow_requests")
+if _invalid_sample_rates:
+    logger.warning(f"Ignoring malformed LOG_SAMPLE_RATES entries: {', '.join(_invalid_sample_rates)}")
 
 # Include the router in the main app
 app.include_router(api_router)
@@ -193,8 +2669,106 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    # Let the chat widget read the validators and paging/timing headers
+    expose_headers=["ETag", "X-Next-Cursor", "Server-Timing"],
 )
 
+if SERVER_TIMING_ENABLED:
+    app.add_middleware(ServerTimingMiddleware)
+
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
+    @app.get("/metrics", include_in_schema=False)
+    async def get_metrics():
+        """Prometheus text exposition of request, MongoDB and n8n metrics"""
+        return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.on_event("startup")
+async def startup_http_client():
+    global http_client
+    http_client = create_http_client()
+
+@app.on_event("startup")
+async def startup_ensure_indexes():
+    if ENSURE_INDEXES_ON_STARTUP:
+        await ensure_status_collection()
+        created = await ensure_indexes()
+        logger.info(f"Index check complete, created {len(created)} index(es): {', '.join(created) or 'none'}")
+
+@app.on_event("startup")
+async def startup_message_writer():
+    global message_writer
+    if CHAT_WRITE_BEHIND:
+        message_writer = MessageWriter(CHAT_WRITE_BATCH_SIZE, CHAT_WRITE_FLUSH_INTERVAL, CHAT_WRITE_QUEUE_SIZE)
+        message_writer.start()
+
+@app.on_event("startup")
+async def startup_chat_job_pool():
+    chat_job_pool.start()
+
+@app.on_event("startup")
+async def startup_warm_up():
+    # Runs in the background so the server can answer /api/ready meanwhile
+    warm_up.start()
+
+# The shutdown handlers below run in order: background chat jobs and streamed
+# replies finish first, then their queued messages are written, then the
+# Mongo client is closed
+@app.on_event("shutdown")
+async def shutdown_warm_up():
+    await warm_up.stop()
+
+@app.on_event("shutdown")
+async def shutdown_chat_job_pool():
+    await chat_job_pool.stop(CHAT_JOB_SHUTDOWN_TIMEOUT)
+
+@app.on_event("shutdown")
+async def shutdown_stream_replies():
+    if stream_reply_tasks:
+        await asyncio.wait(stream_reply_tasks, timeout=CHAT_JOB_SHUTDOWN_TIMEOUT)
+
+@app.on_event("shutdown")
+async def shutdown_message_writer():
+    global message_writer
+    if message_writer is not None:
+        await message_writer.stop()
+        message_writer = None
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    if http_client is not None:
+        await http_client.aclose()
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Smokehouse backend maintenance commands")
+    parser.add_argument("command", choices=["ensure-indexes", "check-indexes", "migrate-buckets"])
+    parser.add_argument(
+        "--delete-source", action="store_true",
+        help="migrate-buckets: delete chat_messages documents once they are copied into buckets",
+    )
+    args = parser.parse_args()
+
+    async def _main() -> int:
+        if args.command == "ensure-indexes":
+            await ensure_status_collection()
+            created = await ensure_indexes()
+            print(json.dumps({"created": created}, indent=2))
+            return 0
+        if args.command == "migrate-buckets":
+            report = await migrate_to_buckets(delete_source=args.delete_source)
+            print(json.dumps(report, indent=2))
+            return 0
+        report = await check_indexes()
+        print(json.dumps(report, indent=2, default=str))
+        return 0 if report["ok"] else 1
+
+    sys.exit(asyncio.run(_main()))
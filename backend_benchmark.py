@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+"""
+Offline load test and benchmark for the BBQ Catering chatbot backend
+
+Runs the FastAPI app from backend/server.py in-process (or on localhost) against
+an in-memory MongoDB stand-in (mongomock-motor) or a local MongoDB, with a fake
+n8n webhook server whose latency and failure rate can be configured. Drives
+concurrent session creation, message sends and history reads and prints a JSON
+report with throughput, p50/p95/p99 latency and error rates per operation.
+
+The `serialization` scenario instead measures the CPU cost of rendering 1000
+chat messages for GET /api/chat/messages, comparing the previous model-per-document
+path with the current direct JSON encoding.
+
+Examples:
+    python backend_benchmark.py --users 200 --concurrency 50 --output run.json
+    python backend_benchmark.py --n8n-latency-ms 300 --n8n-failure-rate 0.1
+    python backend_benchmark.py --mongo-url mongodb://localhost:27017 --compare run.json
+    python backend_benchmark.py --scenario serialization
+
+Server settings are read from the environment as usual, so configurations can be
+compared with e.g. `CHAT_WRITE_BEHIND=true python backend_benchmark.py`.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import sys
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent / "backend"
+
+# Environment prefixes of server settings recorded in the report
+SETTING_PREFIXES = ("N8N_", "CHAT_", "SESSION_", "METRICS_", "SERVER_TIMING_", "SLOW_REQUEST_", "ENSURE_INDEXES_")
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(latencies, errors, wall_seconds, degraded=0):
+    values = sorted(latencies)
+    count = len(values)
+    return {
+        "count": count,
+        "errors": errors,
+        "error_rate": round(errors / count, 4) if count else 0.0,
+        "degraded": degraded,
+        "throughput_rps": round(count / wall_seconds, 2) if wall_seconds else 0.0,
+        "mean_ms": round(sum(values) / count, 3) if count else None,
+        "p50_ms": round(percentile(values, 50), 3) if count else None,
+        "p95_ms": round(percentile(values, 95), 3) if count else None,
+        "p99_ms": round(percentile(values, 99), 3) if count else None,
+        "max_ms": round(values[-1], 3) if count else None,
+    }
+
+
+def create_fake_n8n(latency_ms, jitter_ms, failure_rate):
+    """A stand-in for the n8n webhook with configurable latency and failures"""
+    from starlette.applications import Starlette
+    from starlette.responses import JSONResponse
+    from starlette.routing import Route
+
+    stats = {"requests": 0, "failures": 0}
+
+    async def webhook(request):
+        stats["requests"] += 1
+        payload = await request.json()
+        delay = max(latency_ms + random.uniform(-jitter_ms, jitter_ms), 0) / 1000
+        await asyncio.sleep(delay)
+        if random.random() < failure_rate:
+            stats["failures"] += 1
+            return JSONResponse({"error": "injected failure"}, status_code=500)
+        return JSONResponse({"response": f"Thanks {payload.get('user_name')}, you asked: {payload.get('message')}"})
+
+    app = Starlette(routes=[Route("/webhook", webhook, methods=["POST"])])
+    return app, stats
+
+
+async def serve_on_localhost(app):
+    """Start a uvicorn server for `app` on a free localhost port"""
+    import uvicorn
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning", lifespan="off"))
+    task = asyncio.create_task(server.serve(sockets=[sock]))
+    while not server.started:
+        await asyncio.sleep(0.01)
+    return server, task, f"http://127.0.0.1:{port}"
+
+
+async def stop_server(server, task):
+    server.should_exit = True
+    await task
+
+
+def load_server(args):
+    """Import backend/server.py pointed at the requested MongoDB"""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://127.0.0.1:1"
+    os.environ["DB_NAME"] = args.db_name
+    sys.path.insert(0, str(BACKEND_DIR))
+    import server
+
+    if not args.mongo_url:
+        try:
+            from mongomock_motor import AsyncMongoMockClient
+        except ImportError:
+            sys.exit("mongomock-motor is not installed; install it or pass --mongo-url for a local MongoDB")
+        server.db = AsyncMongoMockClient()[args.db_name]
+    if not args.verbose:
+        # Injected n8n failures would otherwise log an error per message
+        logging.disable(logging.ERROR)
+    return server
+
+
+class BenchmarkRunner:
+    def __init__(self, http, args, fallback_replies):
+        self.http = http
+        self.args = args
+        self.fallback_replies = fallback_replies
+        self.latencies = {}
+        self.errors = {}
+        self.degraded = {}
+
+    async def request(self, operation, method, url, **kwargs):
+        start = time.perf_counter()
+        failed = False
+        response = None
+        try:
+            response = await self.http.request(method, url, **kwargs)
+            failed = response.status_code >= 400
+        except httpx.HTTPError:
+            failed = True
+        self.latencies.setdefault(operation, []).append((time.perf_counter() - start) * 1000)
+        self.errors[operation] = self.errors.get(operation, 0) + int(failed)
+        return None if failed else response
+
+    async def user_flow(self, index, semaphore):
+        """One visitor: open a session, chat, then reload the history"""
+        async with semaphore:
+            response = await self.request("create_session", "POST", "/api/chat/session", json={
+                "user_name": f"Bench User {index}",
+                "user_email": f"bench{index}@example.com",
+            })
+            if response is None:
+                return
+            session_id = response.json()["id"]
+            for turn in range(self.args.messages):
+                response = await self.request("send_message", "POST", "/api/chat/message", json={
+                    "session_id": session_id,
+                    "message": random.choice(self.args.questions) + f" ({turn})",
+                })
+                # A canned apology is a 200 but means n8n did not answer
+                if response is not None and response.json().get("message") in self.fallback_replies:
+                    self.degraded["send_message"] = self.degraded.get("send_message", 0) + 1
+            for _ in range(self.args.history_reads):
+                await self.request("read_history", "GET", f"/api/chat/messages/{session_id}")
+
+    async def run(self):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        start = time.perf_counter()
+        await asyncio.gather(*(self.user_flow(i, semaphore) for i in range(self.args.users)))
+        wall = time.perf_counter() - start
+        all_latencies = [value for values in self.latencies.values() for value in values]
+        operations = {
+            operation: summarize(values, self.errors.get(operation, 0), wall, self.degraded.get(operation, 0))
+            for operation, values in self.latencies.items()
+        }
+        operations["all"] = summarize(all_latencies, sum(self.errors.values()), wall, sum(self.degraded.values()))
+        return wall, operations
+
+
+def compare(current, baseline):
+    """Relative change (in percent) of the headline numbers against a previous report"""
+    comparison = {}
+    for operation, stats in current["operations"].items():
+        before = baseline.get("operations", {}).get(operation)
+        if not before:
+            continue
+        deltas = {}
+        for key in ("throughput_rps", "p50_ms", "p95_ms", "p99_ms", "error_rate"):
+            if stats.get(key) is not None and before.get(key):
+                deltas[key] = round((stats[key] - before[key]) / before[key] * 100, 1)
+        comparison[operation] = deltas
+    return comparison
+
+
+async def run_load_test(args):
+    server = load_server(args)
+    n8n_app, n8n_stats = create_fake_n8n(args.n8n_latency_ms, args.n8n_jitter_ms, args.n8n_failure_rate)
+    n8n_server, n8n_task, n8n_url = await serve_on_localhost(n8n_app)
+
+    app_server = app_task = None
+    if args.transport == "http":
+        app_server, app_task, base_url = await serve_on_localhost(server.app)
+        transport = None
+    else:
+        base_url = "http://benchmark"
+        transport = httpx.ASGITransport(app=server.app)
+
+    # httpx.ASGITransport does not send lifespan events, so run them directly
+    await server.app.router.startup()
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=base_url, transport=transport, limits=limits, timeout=60.0) as http:
+            await http.put("/api/chat/config", json={"webhook_url": f"{n8n_url}/webhook"})
+            # Hold traffic back until warm-up has finished, as the platform would
+            while (await http.get("/api/ready")).status_code != 200:
+                await asyncio.sleep(0.05)
+            fallback_replies = {server.FALLBACK_REPLY, server.NOT_CONFIGURED_REPLY}
+            wall, operations = await BenchmarkRunner(http, args, fallback_replies).run()
+            server_stats = (await http.get("/api/admin/stats")).json()
+    finally:
+        await server.app.router.shutdown()
+        if app_server is not None:
+            await stop_server(app_server, app_task)
+        await stop_server(n8n_server, n8n_task)
+        if args.mongo_url and not args.keep_db:
+            await server.db.client.drop_database(args.db_name)
+
+    return {
+        "scenario": "load",
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "parameters": {
+            "users": args.users,
+            "messages_per_user": args.messages,
+            "history_reads_per_user": args.history_reads,
+            "concurrency": args.concurrency,
+            "transport": args.transport,
+            "mongo": "local" if args.mongo_url else "in-memory",
+            "n8n_latency_ms": args.n8n_latency_ms,
+            "n8n_jitter_ms": args.n8n_jitter_ms,
+            "n8n_failure_rate": args.n8n_failure_rate,
+        },
+        "settings": {key: value for key, value in sorted(os.environ.items()) if key.startswith(SETTING_PREFIXES)},
+        "wall_seconds": round(wall, 3),
+        "operations": operations,
+        "fake_n8n": n8n_stats,
+        "server_stats": server_stats,
+    }
+
+
+def run_serialization_benchmark(args):
+    """CPU time to turn 1000 stored chat messages into a response body, before and after"""
+    from typing import List
+
+    from bson import ObjectId
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    server = load_server(args)
+    session_id = str(uuid.uuid4())
+    stored = [
+        {
+            "_id": ObjectId(),
+            "id": str(uuid.uuid4()),
+            "session_id": session_id,
+            "message": f"Message {i}: do you have brisket and mac & cheese for 40 guests?",
+            "sender": "user" if i % 2 == 0 else "bot",
+            "timestamp": datetime.utcnow(),
+        }
+        for i in range(1000)
+    ]
+    # The fast path reads with a projection, so Mongo never returns _id
+    projected = [{key: value for key, value in doc.items() if key != "_id"} for doc in stored]
+    field = create_response_field(name="Response", type_=List[server.ChatMessage])
+
+    async def model_path():
+        # Previous handler: a model per document, then response_model validation
+        content = await serialize_response(field=field, response_content=[server.ChatMessage(**doc) for doc in stored])
+        return JSONResponse(content).body
+
+    async def fast_path():
+        return server.json_bytes_response(projected).body
+
+    async def stdlib_path():
+        return json.dumps(projected, default=server._json_default, separators=(",", ":")).encode()
+
+    async def measure(render):
+        await render()
+        start = time.process_time()
+        for _ in range(args.repeat):
+            await render()
+        return (time.process_time() - start) / args.repeat * 1000
+
+    async def run():
+        return {
+            "model_per_document": await measure(model_path),
+            "direct_json": await measure(fast_path),
+            "direct_json_stdlib": await measure(stdlib_path),
+        }
+
+    results = asyncio.run(run())
+    before = results["model_per_document"]
+    return {
+        "scenario": "serialization",
+        "started_at": datetime.utcnow().isoformat(),
+        "python": platform.python_version(),
+        "encoder": "orjson" if server.orjson is not None else "json",
+        "messages": len(stored),
+        "repeat": args.repeat,
+        "cpu_ms_per_1000_messages": {name: round(value, 3) for name, value in results.items()},
+        "speedup": {name: round(before / value, 1) for name, value in results.items() if value},
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the chatbot backend")
+    parser.add_argument("--scenario", choices=["load", "serialization"], default="load")
+    parser.add_argument("--repeat", type=int, default=50, help="iterations for the serialization scenario")
+    parser.add_argument("--users", type=int, default=50, help="chat sessions to simulate")
+    parser.add_argument("--messages", type=int, default=5, help="messages sent per session")
+    parser.add_argument("--history-reads", type=int, default=1, help="history reads per session")
+    parser.add_argument("--concurrency", type=int, default=20, help="sessions running at the same time")
+    parser.add_argument("--transport", choices=["asgi", "http"], default="asgi",
+                        help="call the app in-process or through uvicorn on localhost")
+    parser.add_argument("--mongo-url", help="local MongoDB to use instead of the in-memory stand-in")
+    parser.add_argument("--db-name", default=f"chatbot_bench_{uuid.uuid4().hex[:8]}")
+    parser.add_argument("--keep-db", action="store_true", help="do not drop the benchmark database afterwards")
+    parser.add_argument("--n8n-latency-ms", type=float, default=50.0)
+    parser.add_argument("--n8n-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--n8n-failure-rate", type=float, default=0.0, help="fraction of webhook calls that fail")
+    parser.add_argument("--seed", type=int, help="random seed for reproducible runs")
+    parser.add_argument("--output", help="write the JSON report to this file as well as stdout")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    parser.add_argument("--verbose", action="store_true", help="keep the server's INFO logging")
+    args = parser.parse_args(argv)
+    args.questions = [
+        "How much is the brisket package?",
+        "Do you cater on Christmas?",
+        "What sides come with the menu?",
+        "Can I book for 150 guests?",
+    ]
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    if args.scenario == "serialization":
+        report = run_serialization_benchmark(args)
+    else:
+        report = asyncio.run(run_load_test(args))
+    if args.compare and args.scenario == "load":
+        with open(args.compare) as f:
+            report["comparison"] = compare(report, json.load(f))
+    output = json.dumps(report, indent=2, default=str)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
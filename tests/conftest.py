@@ -0,0 +1,28 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+os.environ.setdefault("MONGO_URL", "mongodb://localhost:27017")
+os.environ.setdefault("DB_NAME", "test_database")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+import server  # noqa: E402
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """Swap the server's database for an in-memory mongomock one"""
+    database = AsyncMongoMockClient()["test_database"]
+    monkeypatch.setattr(server, "db", database)
+    return database
+
+
+@pytest.fixture
+def bucketed(monkeypatch, db):
+    """Bucketed chat storage with small buckets"""
+    monkeypatch.setattr(server, "CHAT_BUCKETED", True)
+    monkeypatch.setattr(server, "CHAT_BUCKET_SIZE", 3)
+    return db
@@ -0,0 +1,193 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def message(session_id: str, msg_id: str, seconds: int) -> dict:
+    return {
+        "id": msg_id,
+        "session_id": session_id,
+        "message": f"message {msg_id}",
+        "sender": "user",
+        "timestamp": T0 + timedelta(seconds=seconds),
+    }
+
+
+def bucket(session_id: str, messages: list, **extra) -> dict:
+    timestamps = [doc["timestamp"] for doc in messages]
+    return {
+        "session_id": session_id,
+        "messages": messages,
+        "count": len(messages),
+        "first_timestamp": min(timestamps),
+        "last_timestamp": max(timestamps),
+        **extra,
+    }
+
+
+async def collect(session_id: str, since=None, after=None) -> list:
+    return [doc["id"] async for doc in server.iter_bucketed_messages(session_id, since, after)]
+
+
+async def insert_overlapping_buckets(db):
+    # Two appends racing to open a bucket leave buckets whose time ranges
+    # overlap, including messages with equal timestamps
+    await db.chat_message_buckets.insert_many([
+        bucket("s1", [message("s1", "a", 0), message("s1", "d", 3), message("s1", "f", 5)]),
+        bucket("s1", [message("s1", "b", 1), message("s1", "c", 3), message("s1", "e", 3)]),
+        bucket("s1", [message("s1", "g", 5), message("s1", "h", 6)]),
+        bucket("s2", [message("s2", "x", 2)]),
+    ])
+
+
+def test_iter_bucketed_messages_merges_overlapping_buckets(bucketed):
+    async def scenario():
+        await insert_overlapping_buckets(bucketed)
+        return await collect("s1")
+
+    assert asyncio.run(scenario()) == ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def test_iter_bucketed_messages_after_cursor_breaks_timestamp_ties_by_id(bucketed):
+    async def scenario():
+        await insert_overlapping_buckets(bucketed)
+        after = server.encode_cursor(message("s1", "d", 3))
+        return await collect("s1", after=after)
+
+    assert asyncio.run(scenario()) == ["e", "f", "g", "h"]
+
+
+def test_iter_bucketed_messages_since_excludes_equal_timestamps(bucketed):
+    async def scenario():
+        await insert_overlapping_buckets(bucketed)
+        return await collect("s1", since=T0 + timedelta(seconds=3))
+
+    assert asyncio.run(scenario()) == ["f", "g", "h"]
+
+
+def test_iter_bucketed_messages_combines_since_and_after(bucketed):
+    async def scenario():
+        await insert_overlapping_buckets(bucketed)
+        since_wins = await collect("s1", since=T0 + timedelta(seconds=3), after=server.encode_cursor(message("s1", "a", 0)))
+        after_wins = await collect("s1", since=T0, after=server.encode_cursor(message("s1", "f", 5)))
+        return since_wins, after_wins
+
+    assert asyncio.run(scenario()) == (["f", "g", "h"], ["g", "h"])
+
+
+def test_fetch_chat_page_walks_all_messages_across_pages(bucketed):
+    async def scenario():
+        await insert_overlapping_buckets(bucketed)
+        seen, after = [], None
+        while True:
+            docs, after = await server.fetch_chat_page("s1", 3, after)
+            seen.extend(doc["id"] for doc in docs)
+            if after is None:
+                return seen
+
+    assert asyncio.run(scenario()) == ["a", "b", "c", "d", "e", "f", "g", "h"]
+
+
+def test_store_chat_messages_appends_to_open_live_bucket(bucketed):
+    async def scenario():
+        await bucketed.chat_message_buckets.insert_many([
+            bucket("s1", [message("s1", "a", 0), message("s1", "b", 1), message("s1", "c", 2)], _id="full"),
+            bucket("s1", [message("s1", "d", 3)], _id="migrated", migrated_at=T0),
+            bucket("s1", [message("s1", "f", 5)], _id="open"),
+            bucket("s2", [message("s2", "x", 0)], _id="other"),
+        ])
+        await server.store_chat_messages([message("s1", "e", 4)])
+        return {doc["_id"]: doc for doc in await bucketed.chat_message_buckets.find().to_list(None)}
+
+    buckets = asyncio.run(scenario())
+    assert len(buckets) == 4
+    assert [doc["id"] for doc in buckets["open"]["messages"]] == ["e", "f"]
+    assert buckets["open"]["count"] == 2
+    assert buckets["open"]["first_timestamp"] == T0 + timedelta(seconds=4)
+    assert buckets["open"]["last_timestamp"] == T0 + timedelta(seconds=5)
+    assert buckets["migrated"]["count"] == 1
+    assert buckets["other"]["count"] == 1
+
+
+def test_store_chat_messages_opens_a_bucket_when_none_has_room(bucketed):
+    async def scenario():
+        await bucketed.chat_message_buckets.insert_one(
+            bucket("s1", [message("s1", "a", 0), message("s1", "b", 1)], _id="open")
+        )
+        await server.store_chat_messages([message("s1", "c", 2), message("s1", "d", 3)])
+        return await bucketed.chat_message_buckets.find({}, {"_id": 0}).sort("first_timestamp", 1).to_list(None)
+
+    buckets = asyncio.run(scenario())
+    assert [(doc["count"], [m["id"] for m in doc["messages"]]) for doc in buckets] == [
+        (2, ["a", "b"]),
+        (2, ["c", "d"]),
+    ]
+    assert buckets[1]["first_timestamp"] == T0 + timedelta(seconds=2)
+    assert buckets[1]["last_timestamp"] == T0 + timedelta(seconds=3)
+    assert "migrated_at" not in buckets[1]
+
+
+def test_store_chat_messages_splits_batches_into_bucket_sized_buckets(bucketed):
+    async def scenario():
+        docs = [message("s1", str(i), i) for i in range(7)] + [message("s2", "x", 0)]
+        await server.store_chat_messages(docs)
+        return await bucketed.chat_message_buckets.find({}, {"_id": 0}).to_list(None)
+
+    buckets = asyncio.run(scenario())
+    assert sorted((doc["session_id"], doc["count"]) for doc in buckets) == [("s1", 1), ("s1", 3), ("s1", 3), ("s2", 1)]
+
+
+def test_migrate_to_buckets_replaces_previous_run(bucketed):
+    async def scenario():
+        await bucketed.chat_messages.insert_many(
+            [message("s1", str(i), i) for i in range(4)] + [message("s2", "x", 0)]
+        )
+        # A bucket appended by live traffic is not part of the migration
+        await bucketed.chat_message_buckets.insert_one(bucket("s1", [message("s1", "live", 9)]))
+        first = await server.migrate_to_buckets()
+        second = await server.migrate_to_buckets()
+        buckets = await bucketed.chat_message_buckets.find({}, {"_id": 0}).to_list(None)
+        return first, second, buckets, await collect("s1")
+
+    first, second, buckets, s1 = asyncio.run(scenario())
+    assert first == second == {"sessions": 2, "messages": 5, "buckets": 3, "deleted": 0}
+    assert sorted(b["count"] for b in buckets if "migrated_at" in b) == [1, 1, 3]
+    assert len(buckets) == 4
+    assert s1 == ["0", "1", "2", "3", "live"]
+
+
+def test_migrate_to_buckets_delete_source(bucketed):
+    async def scenario():
+        await bucketed.chat_messages.insert_many([message("s1", str(i), i) for i in range(4)])
+        report = await server.migrate_to_buckets(delete_source=True)
+        rerun = await server.migrate_to_buckets(delete_source=True)
+        remaining = await bucketed.chat_messages.count_documents({})
+        return report, rerun, remaining, await collect("s1")
+
+    report, rerun, remaining, s1 = asyncio.run(scenario())
+    assert report == {"sessions": 1, "messages": 4, "buckets": 2, "deleted": 4}
+    assert remaining == 0
+    # Nothing is left to copy, and the buckets already written are kept
+    assert rerun == {"sessions": 0, "messages": 0, "buckets": 0, "deleted": 0}
+    assert s1 == ["0", "1", "2", "3"]
+
+
+def test_migrate_to_buckets_rerun_after_delete_source_keeps_history(bucketed):
+    async def scenario():
+        await bucketed.chat_messages.insert_many([message("s1", str(i), i) for i in range(4)])
+        await server.migrate_to_buckets(delete_source=True)
+        # More traffic reaches chat_messages before storage is switched over
+        await bucketed.chat_messages.insert_one(message("s1", "4", 4))
+        report = await server.migrate_to_buckets(delete_source=True)
+        remaining = await bucketed.chat_messages.count_documents({})
+        buckets = await bucketed.chat_message_buckets.find({}, {"_id": 0, "count": 1}).to_list(None)
+        return report, remaining, buckets, await collect("s1")
+
+    report, remaining, buckets, s1 = asyncio.run(scenario())
+    assert report == {"sessions": 1, "messages": 1, "buckets": 2, "deleted": 1}
+    assert remaining == 0
+    assert sorted(doc["count"] for doc in buckets) == [2, 3]
+    assert s1 == ["0", "1", "2", "3", "4"]
@@ -0,0 +1,85 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def pool(monkeypatch, db):
+    job_pool = server.ChatJobPool(concurrency=1, max_queue=2, result_ttl=60)
+    monkeypatch.setattr(server, "chat_job_pool", job_pool)
+    asyncio.run(db.chat_sessions.insert_one({"id": "s1", "user_name": "Pat", "user_email": "pat@example.com"}))
+    monkeypatch.setattr(server, "session_cache", server.TTLCache(10, 60))
+    return job_pool
+
+
+def job(status: str) -> dict:
+    now = datetime.utcnow()
+    return {"id": "bot-1", "session_id": "s1", "status": status, "created_at": now, "updated_at": now}
+
+
+@pytest.mark.parametrize("status, expected", [("pending", 202), ("done", 202), ("failed", 404)])
+def test_job_accepted_by_another_worker(db, pool, status, expected):
+    asyncio.run(db.chat_jobs.insert_one(job(status)))
+    response = TestClient(server.app).get("/api/chat/message/bot-1")
+    assert response.status_code == expected
+
+
+def test_unknown_message_is_not_found(db, pool):
+    assert TestClient(server.app).get("/api/chat/message/bot-1").status_code == 404
+
+
+def test_saved_reply_wins_over_the_marker(db, pool):
+    async def setup():
+        await db.chat_jobs.insert_one(job("done"))
+        await server.store_chat_messages([{
+            "id": "bot-1", "session_id": "s1", "message": "Ribs are ready", "sender": "bot",
+            "timestamp": datetime.utcnow(),
+        }])
+
+    asyncio.run(setup())
+    response = TestClient(server.app).get("/api/chat/message/bot-1")
+    assert response.status_code == 200
+    assert response.json()["message"] == "Ribs are ready"
+
+
+def test_accepted_message_records_a_pending_marker(db, pool):
+    response = TestClient(server.app).post("/api/chat/message/async", json={"session_id": "s1", "message": "Hi"})
+    assert response.status_code == 202
+    bot_message_id = response.json()["bot_message_id"]
+    marker = asyncio.run(db.chat_jobs.find_one({"id": bot_message_id}))
+    assert marker["status"] == "pending"
+    assert marker["session_id"] == "s1"
+
+
+def test_rejected_message_leaves_no_marker(db, pool):
+    client = TestClient(server.app)
+    for _ in range(2):
+        client.post("/api/chat/message/async", json={"session_id": "s1", "message": "Hi"})
+    response = client.post("/api/chat/message/async", json={"session_id": "s1", "message": "Hi"})
+    assert response.status_code == 503
+    assert asyncio.run(db.chat_jobs.count_documents({})) == 2
+    assert asyncio.run(db.chat_messages.count_documents({})) == 2
+
+
+@pytest.mark.parametrize("reply, status", [("Ribs are ready", "done"), (RuntimeError("n8n exploded"), "failed")])
+def test_worker_marks_the_job_finished(db, pool, monkeypatch, reply, status):
+    async def get_bot_reply(session, message):
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(server, "get_bot_reply", get_bot_reply)
+
+    async def scenario():
+        pool.start()
+        await server.record_chat_job("bot-1", server.ChatMessage(session_id="s1", message="Hi", sender="user"))
+        pool.submit({"id": "s1"}, "Hi", "bot-1")
+        await pool.wait_for("bot-1", 1)
+        await pool.stop(1)
+        return await db.chat_jobs.find_one({"id": "bot-1"})
+
+    assert asyncio.run(scenario())["status"] == status
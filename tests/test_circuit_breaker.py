@@ -0,0 +1,68 @@
+import pytest
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_consecutive_failures(clock):
+    breaker = server.CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == breaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.allow() is False
+    assert breaker.stats()["rejected"] == 1
+    assert breaker.trips == 1
+
+
+def test_half_open_lets_a_single_trial_through(clock):
+    breaker = server.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+
+
+def test_successful_trial_closes(clock):
+    breaker = server.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow() is True
+    breaker.record_success()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.failures == 0
+    assert breaker.allow() is True
+
+
+def test_failed_trial_reopens_for_a_full_timeout(clock):
+    breaker = server.CircuitBreaker(failure_threshold=3, reset_timeout=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow() is True
+    breaker.record_failure()
+    assert breaker.state == breaker.OPEN
+    assert breaker.trips == 2
+    clock[0] += 29
+    assert breaker.allow() is False
+    clock[0] += 1
+    assert breaker.allow() is True
+
+
+def test_released_trial_frees_the_half_open_slot(clock):
+    breaker = server.CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    clock[0] += 30
+    assert breaker.allow() is True
+    breaker.release()
+    assert breaker.state == breaker.HALF_OPEN
+    assert breaker.allow() is True
@@ -0,0 +1,93 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def message(msg_id: str, seconds: int) -> dict:
+    return {
+        "id": msg_id,
+        "session_id": "s1",
+        "message": f"message {msg_id}",
+        "sender": "user",
+        "timestamp": T0 + timedelta(seconds=seconds),
+    }
+
+
+def history_ids(response) -> list:
+    return [doc["id"] for doc in response.json()]
+
+
+@pytest.fixture
+def client(db):
+    asyncio.run(server.store_chat_messages([message("a", 0), message("c", 1), message("b", 1), message("d", 2)]))
+    return TestClient(server.app)
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, False),
+    ('W/"abc"', True),
+    ('"abc"', True),
+    ('"xyz", W/"abc"', True),
+    ("*", True),
+    ('W/"abcd"', False),
+])
+def test_etag_matches(header, expected):
+    assert server.etag_matches(header, 'W/"abc"') is expected
+
+
+def test_unchanged_history_is_not_modified(client):
+    first = client.get("/api/chat/messages/s1")
+    assert history_ids(first) == ["a", "b", "c", "d"]
+    etag = first.headers["ETag"]
+
+    again = client.get("/api/chat/messages/s1", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert again.content == b""
+
+
+def test_new_message_changes_the_etag(client):
+    etag = client.get("/api/chat/messages/s1").headers["ETag"]
+    asyncio.run(server.store_chat_messages([message("e", 3)]))
+
+    response = client.get("/api/chat/messages/s1", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert history_ids(response) == ["a", "b", "c", "d", "e"]
+
+
+def test_etag_depends_on_the_query(client):
+    full = client.get("/api/chat/messages/s1").headers["ETag"]
+    paged = client.get("/api/chat/messages/s1", params={"limit": 2})
+    assert paged.headers["ETag"] != full
+    assert client.get("/api/chat/messages/s1", params={"limit": 2}, headers={"If-None-Match": full}).status_code == 200
+
+
+def test_since_timestamp_returns_strictly_newer_messages(client):
+    response = client.get("/api/chat/messages/s1", params={"since": (T0 + timedelta(seconds=1)).isoformat()})
+    assert history_ids(response) == ["d"]
+    # Aware timestamps are compared in UTC
+    response = client.get("/api/chat/messages/s1", params={"since": "2024-01-01T13:00:00.500+01:00"})
+    assert history_ids(response) == ["b", "c", "d"]
+
+
+def test_since_message_id_resumes_after_that_message(client):
+    assert history_ids(client.get("/api/chat/messages/s1", params={"since": "b"})) == ["c", "d"]
+    # Unknown IDs, or IDs from another session, fall back to the full history
+    assert history_ids(client.get("/api/chat/messages/s1", params={"since": "zzz"})) == ["a", "b", "c", "d"]
+
+
+def test_since_works_with_bucketed_storage(bucketed):
+    asyncio.run(server.store_chat_messages([message("a", 0), message("b", 1), message("c", 1), message("d", 2)]))
+    client = TestClient(server.app)
+    etag = client.get("/api/chat/messages/s1").headers["ETag"]
+    assert history_ids(client.get("/api/chat/messages/s1", params={"since": "b"})) == ["c", "d"]
+
+    asyncio.run(server.store_chat_messages([message("e", 3)]))
+    assert client.get("/api/chat/messages/s1", headers={"If-None-Match": etag}).status_code == 200
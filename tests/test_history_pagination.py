@@ -0,0 +1,80 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+import server
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def status_check(check_id: str, seconds: int) -> dict:
+    return {"id": check_id, "client_name": "uptime", "timestamp": T0 + timedelta(seconds=seconds)}
+
+
+async def insert_checks(db):
+    # b, c and d share a timestamp, so only the id orders them
+    await db.status_checks.insert_many([
+        status_check("d", 1), status_check("a", 0), status_check("c", 1), status_check("b", 1), status_check("e", 2),
+    ])
+
+
+def test_cursor_round_trip():
+    doc = status_check("abc", 0)
+    assert server.decode_cursor(server.encode_cursor(doc)) == (doc["timestamp"], "abc")
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", "e30", server.encode_cursor(status_check("a", 0))[:-3]])
+def test_invalid_cursor_is_a_bad_request(cursor):
+    with pytest.raises(HTTPException) as excinfo:
+        server.decode_cursor(cursor)
+    assert excinfo.value.status_code == 400
+
+
+def test_keyset_query_breaks_timestamp_ties_by_id():
+    after = server.encode_cursor(status_check("c", 1))
+    assert server.keyset_query({"client_name": "uptime"}, after) == {
+        "client_name": "uptime",
+        "$or": [
+            {"timestamp": {"$gt": T0 + timedelta(seconds=1)}},
+            {"timestamp": T0 + timedelta(seconds=1), "id": {"$gt": "c"}},
+        ],
+    }
+    assert server.keyset_query({"client_name": "uptime"}, None) == {"client_name": "uptime"}
+
+
+def test_fetch_page_walks_ties_without_gaps_or_repeats(db):
+    async def scenario():
+        await insert_checks(db)
+        pages, after = [], None
+        while True:
+            docs, after = await server.fetch_page(db.status_checks, {}, server.STATUS_CHECK_PROJECTION, 2, after)
+            pages.append([doc["id"] for doc in docs])
+            if after is None:
+                return pages
+
+    assert asyncio.run(scenario()) == [["a", "b"], ["c", "d"], ["e"]]
+
+
+def test_status_endpoint_pages_and_streams(db):
+    asyncio.run(insert_checks(db))
+    client = TestClient(server.app)
+
+    legacy = client.get("/api/status")
+    assert [doc["id"] for doc in legacy.json()] == ["a", "b", "c", "d", "e"]
+    assert "X-Next-Cursor" not in legacy.headers
+
+    first = client.get("/api/status", params={"limit": 3}).json()
+    assert [doc["id"] for doc in first["items"]] == ["a", "b", "c"]
+    second = client.get("/api/status", params={"limit": 3, "after": first["next_cursor"]}).json()
+    assert [doc["id"] for doc in second["items"]] == ["d", "e"]
+    assert second["next_cursor"] is None
+
+    streamed = client.get("/api/status", params={"stream": "true", "after": first["next_cursor"]})
+    assert streamed.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line)["id"] for line in streamed.text.splitlines()] == ["d", "e"]
+
+    assert client.get("/api/status", params={"after": "not a cursor"}).status_code == 400
@@ -0,0 +1,223 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def idempotency_state(monkeypatch, db):
+    monkeypatch.setattr(server, "idempotent_replies", server.TTLCache(100, 60))
+    monkeypatch.setattr(server, "idempotent_in_flight", {})
+    monkeypatch.setattr(server, "idempotency_stats", {"replayed": 0, "coalesced": 0})
+
+
+def counting_turn(reply: str, gate: asyncio.Event = None):
+    calls = []
+
+    async def run():
+        calls.append(1)
+        if gate is not None:
+            await gate.wait()
+        return server.ChatMessage(session_id="s1", message=reply, sender="bot")
+
+    return run, calls
+
+
+def test_concurrent_duplicates_share_one_run():
+    async def scenario():
+        gate = asyncio.Event()
+        run, calls = counting_turn("Brisket is ready", gate)
+        tasks = [asyncio.create_task(server.run_idempotent_turn("s1", "k1", run)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        gate.set()
+        results = await asyncio.gather(*tasks)
+        return calls, results
+
+    calls, results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert len({result.id for result in results}) == 1
+    assert server.idempotency_stats["coalesced"] == 2
+    assert not server.idempotent_in_flight
+
+
+def test_repeat_after_completion_is_replayed():
+    async def scenario():
+        run, calls = counting_turn("Brisket is ready")
+        first = await server.run_idempotent_turn("s1", "k1", run)
+        second = await server.run_idempotent_turn("s1", "k1", run)
+        other = await server.run_idempotent_turn("s2", "k1", run)
+        return calls, first, second, other
+
+    calls, first, second, other = asyncio.run(scenario())
+    assert len(calls) == 2
+    assert second.id == first.id
+    assert other.id != first.id
+    assert server.idempotency_stats["replayed"] == 1
+
+
+def test_degraded_reply_is_not_replayed():
+    async def scenario():
+        run, calls = counting_turn(server.FALLBACK_REPLY)
+        await server.run_idempotent_turn("s1", "k1", run)
+        await server.run_idempotent_turn("s1", "k1", run)
+        return calls
+
+    assert len(asyncio.run(scenario())) == 2
+    assert server.idempotency_stats["replayed"] == 0
+
+
+def test_failure_is_shared_with_duplicates_and_not_remembered():
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def failing():
+            await gate.wait()
+            raise RuntimeError("n8n exploded")
+
+        tasks = [asyncio.create_task(server.run_idempotent_turn("s1", "k1", failing)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        gate.set()
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        run, calls = counting_turn("Brisket is ready")
+        retry = await server.run_idempotent_turn("s1", "k1", run)
+        return outcomes, calls, retry
+
+    outcomes, calls, retry = asyncio.run(scenario())
+    assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+    assert len(calls) == 1
+    assert retry.message == "Brisket is ready"
+
+
+def test_stored_reply_from_another_worker_is_replayed(db):
+    async def scenario():
+        stored = server.ChatMessage(session_id="s1", message="Brisket is ready", sender="bot")
+        await db.chat_messages.insert_one({**stored.model_dump(), "idempotency_key": "k1"})
+        run, calls = counting_turn("Pulled pork is ready")
+        result = await server.run_idempotent_turn("s1", "k1", run)
+        return stored, calls, result
+
+    stored, calls, result = asyncio.run(scenario())
+    assert calls == []
+    assert result.id == stored.id
+
+
+@pytest.fixture
+def chat(db, monkeypatch):
+    """A session, an idle job pool and a stand-in for the streamed n8n reply"""
+    asyncio.run(db.chat_sessions.insert_one({"id": "s1", "user_name": "Pat", "user_email": "pat@example.com"}))
+    monkeypatch.setattr(server, "session_cache", server.TTLCache(10, 60))
+    monkeypatch.setattr(server, "chat_job_pool", server.ChatJobPool(concurrency=1, max_queue=10, result_ttl=60))
+    replies, calls = [], []
+
+    async def stream_bot_reply(session, message):
+        calls.append(message)
+        for chunk in replies.pop(0):
+            yield chunk
+
+    monkeypatch.setattr(server, "stream_bot_reply", stream_bot_reply)
+    return TestClient(server.app), replies, calls
+
+
+def sse_events(response) -> list:
+    events = []
+    for block in response.text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        events.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return events
+
+
+def count_messages(db, sender: str) -> int:
+    return asyncio.run(db.chat_messages.count_documents({"sender": sender}))
+
+
+def test_streamed_retry_replays_the_reply(db, chat):
+    client, replies, calls = chat
+    replies.append(["Brisket ", "is ready"])
+    body = {"session_id": "s1", "message": "Is it ready?"}
+
+    first = sse_events(client.post("/api/chat/message/stream", json=body, headers={"Idempotency-Key": "k1"}))
+    second = sse_events(client.post("/api/chat/message/stream", json={**body, "client_message_id": "k1"}))
+
+    assert [event for event, _ in first] == ["start", "token", "token", "done"]
+    assert [event for event, _ in second] == ["start", "token", "done"]
+    assert second[0][1] == {"user_message_id": None, "bot_message_id": first[0][1]["bot_message_id"], "replayed": True}
+    assert second[1][1] == {"text": "Brisket is ready"}
+    assert second[2][1]["id"] == first[3][1]["id"]
+    assert calls == ["Is it ready?"]
+    assert count_messages(db, "user") == count_messages(db, "bot") == 1
+
+
+def test_streamed_apology_is_not_replayed(db, chat):
+    client, replies, calls = chat
+    replies.extend([[server.FALLBACK_REPLY], ["Brisket is ready"]])
+    body = {"session_id": "s1", "message": "Is it ready?", "client_message_id": "k1"}
+
+    client.post("/api/chat/message/stream", json=body)
+    retry = sse_events(client.post("/api/chat/message/stream", json=body))
+
+    assert retry[-1][1]["message"] == "Brisket is ready"
+    assert len(calls) == 2
+
+
+def test_async_retry_returns_the_original_job(db, chat):
+    client, _, _ = chat
+    body = {"session_id": "s1", "message": "Is it ready?"}
+
+    first = client.post("/api/chat/message/async", json=body, headers={"Idempotency-Key": "k1"})
+    second = client.post("/api/chat/message/async", json={**body, "client_message_id": "k1"})
+
+    assert first.status_code == second.status_code == 202
+    assert second.json()["bot_message_id"] == first.json()["bot_message_id"]
+    assert second.json()["user_message"]["id"] == first.json()["user_message"]["id"]
+    assert second.json()["status"] == "pending"
+    assert server.chat_job_pool.queue.qsize() == 1
+    assert count_messages(db, "user") == 1
+
+
+def test_async_retry_after_a_failed_job_runs_again(db, chat):
+    client, _, _ = chat
+    body = {"session_id": "s1", "message": "Is it ready?", "client_message_id": "k1"}
+
+    first = client.post("/api/chat/message/async", json=body).json()
+    asyncio.run(server.finish_chat_job(first["bot_message_id"], "failed", release_key=True))
+    second = client.post("/api/chat/message/async", json=body).json()
+
+    assert second["bot_message_id"] != first["bot_message_id"]
+    assert server.chat_job_pool.queue.qsize() == 2
+
+
+def test_async_retry_after_the_marker_expired_uses_the_history(db, chat):
+    client, _, _ = chat
+    body = {"session_id": "s1", "message": "Is it ready?", "client_message_id": "k1"}
+    first = client.post("/api/chat/message/async", json=body).json()
+
+    async def finish_and_expire():
+        reply = server.ChatMessage(id=first["bot_message_id"], session_id="s1", message="Brisket is ready", sender="bot")
+        await server.save_chat_message(reply, idempotency_key="k1")
+        await db.chat_jobs.delete_many({})
+
+    asyncio.run(finish_and_expire())
+    second = client.post("/api/chat/message/async", json=body).json()
+
+    assert second["status"] == "done"
+    assert second["bot_message_id"] == first["bot_message_id"]
+    assert second["user_message"]["id"] == first["user_message"]["id"]
+
+
+def test_concurrent_async_duplicates_share_one_marker(db):
+    async def scenario():
+        await db.chat_jobs.create_index(
+            [("session_id", 1), ("idempotency_key", 1)],
+            unique=True, partialFilterExpression={"idempotency_key": {"$exists": True}},
+        )
+        user_message = server.ChatMessage(session_id="s1", message="Is it ready?", sender="user")
+        first = await server.record_chat_job("bot-1", user_message, "k1")
+        second = await server.record_chat_job("bot-2", user_message, "k1")
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert first is None
+    assert second["id"] == "bot-1"
@@ -0,0 +1,70 @@
+import json
+import logging
+
+import pytest
+
+import server
+
+
+def make_record(name: str = "server", level: int = logging.INFO, **extra) -> logging.LogRecord:
+    record = logging.LogRecord(name, level, __file__, 1, "Slow request", None, None)
+    record.__dict__.update(extra)
+    return record
+
+
+@pytest.mark.parametrize("raw, rates, invalid", [
+    ("", {}, []),
+    ("slow_request=0.5, httpx=0", {"slow_request": 0.5, "httpx": 0.0}, []),
+    ("slow_request=half,,uvicorn.access=0.1,oops", {"uvicorn.access": 0.1}, ["slow_request=half", "oops"]),
+])
+def test_parse_sample_rates(raw, rates, invalid):
+    assert server.parse_sample_rates(raw) == (rates, invalid)
+
+
+def test_sampling_by_event_and_by_logger_name(monkeypatch):
+    monkeypatch.setattr(server.random, "random", lambda: 0.5)
+    sampler = server.SamplingFilter({"slow_request": 0.4, "uvicorn.access": 0.6, "httpx": 0})
+
+    assert not sampler.filter(make_record(event="slow_request"))
+    assert sampler.filter(make_record(event="chat_session_created"))
+    assert sampler.filter(make_record("uvicorn.access"))
+    assert not sampler.filter(make_record("httpx"))
+    # An event name takes precedence over the logger name
+    assert sampler.filter(make_record("httpx", event="chat_session_created"))
+    assert sampler.sampled_out == {"slow_request": 1, "httpx": 1}
+
+
+def test_errors_are_never_sampled():
+    sampler = server.SamplingFilter({"slow_request": 0, "httpx": 0})
+    assert sampler.filter(make_record(level=logging.ERROR, event="slow_request"))
+    assert sampler.filter(make_record("httpx", level=logging.ERROR))
+    assert sampler.sampled_out == {}
+
+
+def test_text_format_keeps_extra_fields():
+    formatter = server.TextFormatter("%(name)s - %(levelname)s - %(message)s")
+    line = formatter.format(make_record(
+        "server.slow_requests", logging.WARNING, event="slow_request", total_ms=2100.5,
+        phases=[{"name": "n8n", "ms": 2050.1}],
+    ))
+    assert line == (
+        'server.slow_requests - WARNING - Slow request event="slow_request" total_ms=2100.5 '
+        'phases=[{"name": "n8n", "ms": 2050.1}]'
+    )
+    assert formatter.format(make_record()) == "server - INFO - Slow request"
+
+
+def test_text_format_puts_tracebacks_after_the_fields():
+    formatter = server.TextFormatter("%(message)s")
+    record = make_record(event="warmup_retry")
+    record.exc_text = "Traceback (most recent call last):\n  boom"
+    assert formatter.format(record).splitlines() == [
+        'Slow request event="warmup_retry"', "Traceback (most recent call last):", "  boom",
+    ]
+
+
+def test_json_format_keeps_extra_fields():
+    entry = json.loads(server.JsonFormatter().format(make_record(event="slow_request", total_ms=2100.5)))
+    assert entry["message"] == "Slow request"
+    assert entry["event"] == "slow_request"
+    assert entry["total_ms"] == 2100.5
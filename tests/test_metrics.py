@@ -0,0 +1,48 @@
+from fastapi.testclient import TestClient
+
+import server
+
+
+def test_render_metrics_exposition(monkeypatch):
+    requests = server.Counter("test_requests_total", "Requests", ("route", "status"))
+    latency = server.Histogram("test_latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+    monkeypatch.setattr(server, "METRICS", [requests, latency])
+    requests.inc(("/api/chat", "200"))
+    requests.inc(("/api/chat", "200"))
+    requests.inc(('/api/"odd"\n', "500"))
+    latency.observe(("/api/chat",), 0.05)
+    latency.observe(("/api/chat",), 0.1)
+    latency.observe(("/api/chat",), 2.5)
+
+    assert server.render_metrics().splitlines() == [
+        "# HELP test_requests_total Requests",
+        "# TYPE test_requests_total counter",
+        'test_requests_total{route="/api/chat",status="200"} 2',
+        'test_requests_total{route="/api/\\"odd\\"\\n",status="500"} 1',
+        "# HELP test_latency_seconds Latency",
+        "# TYPE test_latency_seconds histogram",
+        'test_latency_seconds_bucket{route="/api/chat",le="0.1"} 2',
+        'test_latency_seconds_bucket{route="/api/chat",le="1.0"} 2',
+        'test_latency_seconds_bucket{route="/api/chat",le="+Inf"} 3',
+        'test_latency_seconds_sum{route="/api/chat"} 2.65',
+        'test_latency_seconds_count{route="/api/chat"} 3',
+    ]
+
+
+def test_gauge_goes_down():
+    gauge = server.Gauge("test_in_progress", "In progress")
+    gauge.inc()
+    gauge.inc()
+    gauge.dec()
+    assert gauge.samples() == ["test_in_progress 1"]
+
+
+def test_requests_are_labelled_by_route_template(db):
+    client = TestClient(server.app)
+    client.get("/api/chat/messages/some-session-id")
+    client.get("/no/such/path")
+
+    body = client.get("/metrics").text
+    assert 'http_requests_total{method="GET",route="/api/chat/messages/{session_id}",status="200"}' in body
+    assert 'http_requests_total{method="GET",route="unmatched",status="404"}' in body
+    assert "some-session-id" not in body
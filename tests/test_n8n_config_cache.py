@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+
+@pytest.fixture
+def cache(db):
+    # A zero TTL re-checks the stored version on every get()
+    return server.N8nConfigCache(ttl=0)
+
+
+def test_reloads_only_when_the_version_changes(db, cache):
+    async def scenario():
+        await db.n8n_config.insert_one({"webhook_url": "https://n8n/one", "version": "v1"})
+        first = await cache.get()
+        second = await cache.get()
+        await db.n8n_config.replace_one({}, {"webhook_url": "https://n8n/two", "version": "v2"})
+        third = await cache.get()
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first["webhook_url"] == second["webhook_url"] == "https://n8n/one"
+    assert third["webhook_url"] == "https://n8n/two"
+    assert cache.refreshes == 3
+    assert cache.reloads == 2
+    assert cache.version == "v2"
+
+
+def test_unversioned_documents_are_always_reloaded(db, cache):
+    async def scenario():
+        await db.n8n_config.insert_one({"webhook_url": "https://n8n/legacy"})
+        await cache.get()
+        await db.n8n_config.update_one({}, {"$set": {"webhook_url": "https://n8n/edited"}})
+        return await cache.get()
+
+    assert asyncio.run(scenario())["webhook_url"] == "https://n8n/edited"
+    assert cache.reloads == 2
+
+
+def test_missing_config_is_not_cached(db):
+    cache = server.N8nConfigCache(ttl=60)
+
+    async def scenario():
+        empty = await cache.get()
+        await db.n8n_config.insert_one({"webhook_url": "https://n8n/one", "version": "v1"})
+        return empty, await cache.get()
+
+    empty, configured = asyncio.run(scenario())
+    assert empty == {}
+    assert configured["webhook_url"] == "https://n8n/one"
+
+
+def test_fresh_entries_are_served_from_memory(db):
+    cache = server.N8nConfigCache(ttl=60)
+
+    async def scenario():
+        await db.n8n_config.insert_one({"webhook_url": "https://n8n/one", "version": "v1"})
+        await cache.get()
+        await db.n8n_config.replace_one({}, {"webhook_url": "https://n8n/two", "version": "v2"})
+        stale = await cache.get()
+        cache.invalidate()
+        return stale, await cache.get()
+
+    stale, reloaded = asyncio.run(scenario())
+    assert stale["webhook_url"] == "https://n8n/one"
+    assert reloaded["webhook_url"] == "https://n8n/two"
+    assert cache.hits == 1
+
+
+def test_update_writes_through(db, monkeypatch):
+    cache = server.N8nConfigCache(ttl=60)
+    monkeypatch.setattr(server, "n8n_config_cache", cache)
+    client = TestClient(server.app)
+
+    assert client.put("/api/chat/config", json={"webhook_url": "https://n8n/new"}).status_code == 200
+    assert client.get("/api/chat/config").json() == {"webhook_url": "https://n8n/new"}
+    stored = asyncio.run(db.n8n_config.find({}, {"_id": 0}).to_list(None))
+    assert len(stored) == 1
+    assert stored[0]["version"] == cache.version
+    assert cache.refreshes == 0
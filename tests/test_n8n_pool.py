@@ -0,0 +1,41 @@
+import asyncio
+import sys
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def build_client(monkeypatch):
+    monkeypatch.setattr(server, "n8n_http2", None)
+
+    def build(http2: bool):
+        monkeypatch.setattr(server, "N8N_HTTP2", http2)
+        client = server.create_http_client()
+        monkeypatch.setattr(server, "http_client", client)
+        return client
+
+    yield build
+    if server.http_client is not None:
+        asyncio.run(server.http_client.aclose())
+
+
+def test_pool_stats_report_http2_before_the_client_is_built(monkeypatch):
+    monkeypatch.setattr(server, "n8n_http2", None)
+    monkeypatch.setattr(server, "http_client", None)
+    assert server.get_n8n_pool_stats()["http2"] is None
+
+
+@pytest.mark.parametrize("http2", [False, True])
+def test_pool_stats_report_http2_as_configured(build_client, http2):
+    pytest.importorskip("h2")
+    build_client(http2)
+    assert server.get_n8n_pool_stats()["http2"] is http2
+
+
+def test_pool_stats_report_the_http1_fallback_without_h2(build_client, monkeypatch):
+    # A None entry makes `import h2` raise ImportError
+    monkeypatch.setitem(sys.modules, "h2", None)
+    build_client(True)
+    assert server.get_n8n_pool_stats()["http2"] is False
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+import httpx
+import pytest
+
+import server
+
+
+@pytest.fixture
+def n8n(monkeypatch, db):
+    """A configured webhook answered by `handler`, behind a fresh breaker"""
+    asyncio.run(db.n8n_config.insert_one({"webhook_url": "https://n8n/hook", "version": "v1"}))
+    monkeypatch.setattr(server, "n8n_config_cache", server.N8nConfigCache(ttl=60))
+    monkeypatch.setattr(server, "n8n_breaker", server.CircuitBreaker(failure_threshold=1, reset_timeout=30))
+    monkeypatch.setattr(server, "n8n_bulkhead", asyncio.Semaphore(5))
+    monkeypatch.setattr(server, "n8n_resilience_stats", {
+        "in_flight": 0, "bulkhead_rejections": 0, "retries": 0, "budget_exceeded": 0,
+    })
+    monkeypatch.setattr(server, "N8N_LATENCY_BUDGET", 0.2)
+    handlers = []
+
+    async def dispatch(request):
+        return await handlers[0](request)
+
+    monkeypatch.setattr(server, "http_client", httpx.AsyncClient(transport=httpx.MockTransport(dispatch)))
+    return handlers
+
+
+async def trickle(chunks, delay):
+    for chunk in chunks:
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+async def collect_reply() -> list:
+    return [chunk async for chunk in server.stream_bot_reply({"id": "s1"}, "Is it ready?")]
+
+
+def test_streams_chunks_within_the_budget(n8n):
+    async def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/plain"}, content=trickle([b"Brisket ", b"is ready"], 0))
+
+    n8n.append(handler)
+    assert "".join(asyncio.run(collect_reply())) == "Brisket is ready"
+    assert server.n8n_breaker.state == server.CircuitBreaker.CLOSED
+
+
+def test_trickling_stream_is_cut_off_at_the_budget(n8n):
+    async def handler(request):
+        return httpx.Response(200, headers={"content-type": "text/plain"}, content=trickle([b"a"] * 100, 0.05))
+
+    n8n.append(handler)
+    chunks = asyncio.run(collect_reply())
+    # What already reached the user is kept, without an apology tacked on
+    assert 0 < len(chunks) < 10
+    assert server.FALLBACK_REPLY not in chunks
+    assert server.n8n_resilience_stats["budget_exceeded"] == 1
+    assert server.n8n_resilience_stats["in_flight"] == 0
+    assert server.n8n_breaker.state == server.CircuitBreaker.OPEN
+
+
+def test_slow_response_headers_count_against_the_budget(n8n):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, json={"response": "too late"})
+
+    n8n.append(handler)
+    assert asyncio.run(collect_reply()) == [server.FALLBACK_REPLY]
+    assert server.n8n_resilience_stats["budget_exceeded"] == 1
+
+
+def test_open_breaker_is_logged_as_a_skipped_call(n8n, caplog):
+    caplog.set_level(logging.WARNING, logger="server")
+    server.n8n_breaker.record_failure()
+    caplog.clear()
+
+    assert asyncio.run(collect_reply()) == [server.FALLBACK_REPLY]
+    records = [record for record in caplog.records if record.name == "server"]
+    assert [(record.levelno, getattr(record, "event", None)) for record in records] == [
+        (logging.WARNING, "n8n_call_skipped"),
+    ]
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+SESSION = {"id": "s1", "user_name": "Pat Jones", "user_email": "pat@example.com"}
+
+
+@pytest.fixture
+def reply_cache(monkeypatch):
+    cache = server.TTLCache(100, 60)
+    monkeypatch.setattr(server, "reply_cache", cache)
+    monkeypatch.setattr(server, "reply_cache_key_func", server.normalize_message)
+    monkeypatch.setattr(server, "N8N_REPLY_CACHE_MIN_WORDS", 3)
+    return cache
+
+
+@pytest.fixture
+def n8n_replies(monkeypatch, db):
+    """Configure a webhook and answer each n8n call with the next queued reply"""
+    asyncio.run(db.n8n_config.insert_one({"webhook_url": "https://n8n/hook", "version": "v1"}))
+    monkeypatch.setattr(server, "n8n_config_cache", server.N8nConfigCache(ttl=60))
+    replies, calls = [], []
+
+    async def call_n8n(webhook_url, payload):
+        calls.append(payload["message"])
+        return {"response": replies.pop(0)}
+
+    monkeypatch.setattr(server, "call_n8n", call_n8n)
+    return replies, calls
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("What are your PRICES?", "what are your prices"),
+    ("  what   are\tyour prices!!  ", "what are your prices"),
+    ("¿Qué   menú?", "qué menú"),
+    ("?!", None),
+])
+def test_normalize_message(message, expected):
+    assert server.normalize_message(message) == expected
+
+
+def test_reply_cache_key_skips_short_messages(reply_cache):
+    assert server.reply_cache_key("how much?") is None
+    assert server.reply_cache_key("How much is brisket?") == "how much is brisket"
+
+
+def test_reply_cache_key_is_none_when_disabled(monkeypatch):
+    monkeypatch.setattr(server, "reply_cache", None)
+    assert server.reply_cache_key("How much is brisket?") is None
+
+
+@pytest.mark.parametrize("reply, expected", [
+    ("Brisket is $25 per pound.", True),
+    ("Thanks Pat Jones, brisket is $25.", False),
+    ("We emailed pat@example.com the menu.", False),
+    ("PAT JONES: brisket is $25.", False),
+    # Only whole-word mentions count
+    ("Pat Joneses are welcome.", True),
+])
+def test_is_shareable_reply(reply, expected):
+    assert server.is_shareable_reply(SESSION, reply) is expected
+
+
+def test_single_letter_names_do_not_block_caching():
+    assert server.is_shareable_reply({"user_name": "A", "user_email": ""}, "A rack of ribs is $30.")
+
+
+def test_repeated_question_is_served_from_cache(reply_cache, n8n_replies):
+    replies, calls = n8n_replies
+    replies.append("Brisket is $25 per pound.")
+
+    async def scenario():
+        first = await server.get_bot_reply(SESSION, "How much is brisket?")
+        second = await server.get_bot_reply({**SESSION, "id": "s2"}, "how much is BRISKET")
+        return first, second
+
+    assert asyncio.run(scenario()) == ("Brisket is $25 per pound.", "Brisket is $25 per pound.")
+    assert calls == ["How much is brisket?"]
+
+
+def test_personalised_reply_is_not_cached(reply_cache, n8n_replies):
+    replies, calls = n8n_replies
+    replies.extend(["Pat Jones, brisket is $25.", "Brisket is $25."])
+
+    async def scenario():
+        await server.get_bot_reply(SESSION, "How much is brisket?")
+        return await server.get_bot_reply({**SESSION, "user_name": "Sam"}, "How much is brisket?")
+
+    assert asyncio.run(scenario()) == "Brisket is $25."
+    assert len(calls) == 2
+    assert len(reply_cache) == 1
+
+
+def test_purge_bumps_the_config_version(reply_cache, n8n_replies, db):
+    reply_cache.set("how much is brisket", "Brisket is $25 per pound.")
+    response = TestClient(server.app).delete("/api/admin/reply-cache")
+    config = asyncio.run(db.n8n_config.find_one({}, {"_id": 0}))
+
+    assert response.json() == {"message": "Reply cache purged", "purged": 1}
+    assert len(reply_cache) == 0
+    assert config["webhook_url"] == "https://n8n/hook"
+    assert config["version"] not in (None, "v1")
+    assert server.n8n_config_cache.version == config["version"]
+
+
+def test_purge_by_another_worker_clears_the_cache_on_next_check(reply_cache, n8n_replies, db, monkeypatch):
+    replies, calls = n8n_replies
+    replies.extend(["Brisket is $25 per pound.", "Brisket is $27 per pound."])
+    # A zero TTL re-checks the stored version on every turn
+    monkeypatch.setattr(server, "n8n_config_cache", server.N8nConfigCache(ttl=0))
+
+    async def scenario():
+        await server.get_bot_reply(SESSION, "How much is brisket?")
+        await server.get_bot_reply(SESSION, "How much is brisket?")
+        # What DELETE /api/admin/reply-cache on another worker writes
+        await db.n8n_config.update_one({}, {"$set": {"version": "v2"}})
+        return await server.get_bot_reply(SESSION, "How much is brisket?")
+
+    assert asyncio.run(scenario()) == "Brisket is $27 per pound."
+    assert len(calls) == 2
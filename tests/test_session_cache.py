@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, "monotonic", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def session_cache(monkeypatch, db):
+    cache = server.TTLCache(10, 60)
+    monkeypatch.setattr(server, "session_cache", cache)
+    monkeypatch.setattr(server, "SESSION_CACHE_NEGATIVE_TTL", 5)
+    return cache
+
+
+def test_ttl_cache_evicts_least_recently_used(clock):
+    cache = server.TTLCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_ttl_cache_expires_entries(clock):
+    cache = server.TTLCache(10, 60)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=5)
+    clock[0] += 5
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    clock[0] += 55
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 2
+    assert len(cache) == 0
+
+
+def test_ttl_cache_with_no_room_stores_nothing():
+    cache = server.TTLCache(0, 60)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_unknown_sessions_are_remembered_briefly(db, session_cache, clock):
+    async def scenario():
+        first = await server.get_chat_session("s1")
+        second = await server.get_chat_session("s1")
+        await db.chat_sessions.insert_one({"id": "s1", "user_name": "Pat", "user_email": "pat@example.com"})
+        cached_miss = await server.get_chat_session("s1")
+        clock[0] += 5
+        found = await server.get_chat_session("s1")
+        cached_hit = await server.get_chat_session("s1")
+        return first, second, cached_miss, found, cached_hit
+
+    first, second, cached_miss, found, cached_hit = asyncio.run(scenario())
+    assert first is second is cached_miss is None
+    assert found["user_name"] == cached_hit["user_name"] == "Pat"
+    # Only the two misses went to MongoDB
+    assert session_cache.stats()["misses"] == 2
+    assert session_cache.stats()["hits"] == 3
@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime
+
+from fastapi.testclient import TestClient
+
+import server
+
+
+def rollups(db, collection: str) -> list:
+    cursor = db[collection].find({}, {"_id": 0}).sort([("period", 1), ("client_name", 1)])
+    return asyncio.run(cursor.to_list(None))
+
+
+def test_record_status_rollups_upserts_per_minute_and_hour(db):
+    async def scenario():
+        for client_name, timestamp in [
+            ("uptime", datetime(2024, 1, 1, 12, 0, 5)),
+            ("uptime", datetime(2024, 1, 1, 12, 0, 55)),
+            ("uptime", datetime(2024, 1, 1, 12, 1, 0)),
+            ("probe", datetime(2024, 1, 1, 12, 0, 30)),
+            ("uptime", datetime(2024, 1, 1, 13, 0, 0)),
+        ]:
+            await server.record_status_rollups(client_name, timestamp)
+
+    asyncio.run(scenario())
+    assert rollups(db, "status_rollups_minute") == [
+        {"period": datetime(2024, 1, 1, 12, 0), "client_name": "probe", "count": 1},
+        {"period": datetime(2024, 1, 1, 12, 0), "client_name": "uptime", "count": 2},
+        {"period": datetime(2024, 1, 1, 12, 1), "client_name": "uptime", "count": 1},
+        {"period": datetime(2024, 1, 1, 13, 0), "client_name": "uptime", "count": 1},
+    ]
+    assert rollups(db, "status_rollups_hour") == [
+        {"period": datetime(2024, 1, 1, 12), "client_name": "probe", "count": 1},
+        {"period": datetime(2024, 1, 1, 12), "client_name": "uptime", "count": 3},
+        {"period": datetime(2024, 1, 1, 13), "client_name": "uptime", "count": 1},
+    ]
+
+
+def test_concurrent_checks_land_in_one_rollup(db):
+    async def scenario():
+        timestamp = datetime(2024, 1, 1, 12, 0, 5)
+        await asyncio.gather(*(server.record_status_rollups("uptime", timestamp) for _ in range(5)))
+
+    asyncio.run(scenario())
+    assert rollups(db, "status_rollups_minute") == [
+        {"period": datetime(2024, 1, 1, 12, 0), "client_name": "uptime", "count": 5},
+    ]
+
+
+def test_rollups_endpoint_reads_the_range(db):
+    async def scenario():
+        for hour in (10, 11, 12):
+            await server.record_status_rollups("uptime", datetime(2024, 1, 1, hour, 30))
+
+    asyncio.run(scenario())
+    client = TestClient(server.app)
+    response = client.get("/api/status/rollups", params={
+        "granularity": "hour", "start": "2024-01-01T11:15:00", "end": "2024-01-01T12:00:00",
+    }).json()
+    # start is truncated to the hour; end is exclusive
+    assert response["start"] == "2024-01-01T11:00:00"
+    assert [item["period"] for item in response["items"]] == ["2024-01-01T11:00:00"]
+    assert client.get("/api/status/rollups", params={
+        "start": "2024-01-01T12:00:00", "end": "2024-01-01T11:00:00",
+    }).status_code == 400
+
+
+def test_create_status_check_records_rollups(db):
+    client = TestClient(server.app)
+    check = client.post("/api/status", json={"client_name": "uptime"}).json()
+    hour = datetime.fromisoformat(check["timestamp"]).replace(minute=0, second=0, microsecond=0)
+    assert rollups(db, "status_rollups_hour") == [{"period": hour, "client_name": "uptime", "count": 1}]